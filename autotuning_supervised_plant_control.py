@@ -5,13 +5,21 @@
 # out of the running, supervised plant control and proposed alternative PID
 # tunings for it.
 #
+import torch
 import numpy as np
-from datetime import datetime
 
+import metrics
 from ddpg_torch import Agent
+from bayesian_agent import BayesianAgent
+from candidate_screening import CandidateScreening
 from plant_control import PlantControl
+from plant_model import ModelPlant
+from plant_trace import ReplayPlant
+from tuning_index import TuningIndex, VERDICT_NEW, VERDICT_REUSE
 from supervised_plant_control import SupervisedPlantControl
-from episodes import T, SAMPLE_RATE, EPISODE_LENGTH, COL_CONTROL_VARIABLE, COL_PROCESS_VARIABLE, COL_ERROR, save_and_plot_episode
+from realtime import RealtimeMode
+from telemetry import TelemetryRing
+from episodes import OBSERVED_COLUMNS, COL_ERROR, COL_STATE, STATE_FALLBACK, EpisodeConfig, save_and_plot_episode
 
 IS_HARDWARE = False
 
@@ -20,19 +28,67 @@ SET_POINT = 23.0
 
 BENCHMARK_ERROR = 15.0
 FALLBACK_PID_TUNINGS = (20.0, 0.1, 0.01)
+END_ON_SETTLE = False
+
+# the episode configuration of this run, e.g. 60 second episodes for screening
+EPISODE_T = 300         # seconds
+EPISODE_SAMPLE_RATE = 2 # Hz
+N_TRAJECTORY = 12       # points sampled from each observed variable's trajectory
+
+USE_BAYESIAN_AGENT = False
+SCREEN_CANDIDATES = False
+N_CANDIDATES = 32
+
+# skip proposals close to tunings we already know the outcome of
+USE_TUNING_INDEX = False
+MAX_PROPOSALS = 10
 
 MAP_GAINS = [500.0, 50.0, 5.0]
 
 N_ACTIONS = 3
 BATCH_SIZE = 64
 
+# learn in one go at the end of each episode, rather than a little every step
+LEARN_PER_EPISODE = False
+UPDATES_PER_EPISODE = 600
+LEARN_THREADS = 2
+REALTIME_MODE = False # manage garbage collection and pin the control loop to a core, see `realtime.py`
+COMPILE_NETWORKS = False # compile the DDPG networks, see `benchmark_ddpg.py` for whether that pays off
+
+METRICS_PORT = None # e.g. 9100, to serve metrics on http://127.0.0.1:9100/metrics
+METRICS_FILE = None # e.g. "metrics.txt", to write metrics snapshots to a rotating file
+TELEMETRY_NAME = None # e.g. "pid-telemetry", to publish each step to shared memory, see `telemetry.py`
+
+# for deterministic regression runs: record the plant's inputs and outputs, run
+# on the plant model or replay a recorded trace, all in simulated time
+TRACE_FILE = None        # e.g. "plant-trace.csv"
+FAST_SIMULATION = False
+REPLAY_TRACE_FILE = None
+SEED = None
+
+#
+# The settings that a hyperparameter sweep may vary, see `sweep.py`.
+#
+HYPERPARAMETERS = {
+    'alpha': 0.00005,
+    'beta': 0.0005,
+    'tau': 0.001,
+    'batch_size': BATCH_SIZE,
+    'layer1_size': 400,
+    'layer2_size': 300,
+    'map_gains': MAP_GAINS,
+    'benchmark_error': BENCHMARK_ERROR,
+    'noisy_episodes': 250,
+    'random_episodes': 250,
+}
+
 #
 # Due to the action and PID tunings being different data types, we have to be
 # able to map back and forth between them. Luckily for us, it is a simple
 # mapping. We mostly have to map from a chosen action to PID gain values.
 #
-def map_action_to_pid_tunings(action):
-    return (action[0] * MAP_GAINS[0], action[1] * MAP_GAINS[1], action[2] * MAP_GAINS[2])
+def map_action_to_pid_tunings(action, map_gains=MAP_GAINS):
+    return (action[0] * map_gains[0], action[1] * map_gains[1], action[2] * map_gains[2])
 
 
 #
@@ -40,8 +96,8 @@ def map_action_to_pid_tunings(action):
 # simplicity, we always map chosen PID values back to an action, making the code
 # more uniform.
 #
-def map_pid_tunings_to_action(tunings):
-        return [tunings[0] / MAP_GAINS[0], tunings[1] / MAP_GAINS[1], tunings[2] / MAP_GAINS[2]]
+def map_pid_tunings_to_action(tunings, map_gains=MAP_GAINS):
+        return [tunings[0] / map_gains[0], tunings[1] / map_gains[1], tunings[2] / map_gains[2]]
 
 
 #
@@ -50,14 +106,15 @@ def map_pid_tunings_to_action(tunings):
 # known-good values.
 #
 class NoisyAgent:
-    def __init__(self, pid_tunings):
+    def __init__(self, pid_tunings, map_gains=MAP_GAINS):
         self.pid_tunings = pid_tunings
+        self.map_gains = map_gains
 
     def choose_action(self):
         proposed_tunings = [np.random.uniform(self.pid_tunings[0] * 0.9, self.pid_tunings[0] * 1.1),
                             np.random.uniform(self.pid_tunings[1] * 0.9, self.pid_tunings[1] * 1.1),
                             np.random.uniform(self.pid_tunings[2] * 0.9, self.pid_tunings[2] * 1.1)]
-        return map_pid_tunings_to_action(proposed_tunings)
+        return map_pid_tunings_to_action(proposed_tunings, self.map_gains)
 
 
 #
@@ -71,73 +128,205 @@ class RandomAgent:
         return np.random.rand(self.n_actions)
 
 
+#
+# Drop the proposed actions whose tunings are close to tunings we already know
+# the outcome of. Known, stable results are handed to `on_known_result`, so
+# that an agent can learn from them without running them again.
+#
+def filter_known_actions(tuning_index, actions, on_known_result=None, map_gains=MAP_GAINS):
+    novel_actions = []
+    for action in actions:
+        verdict, record = tuning_index.verdict(map_action_to_pid_tunings(action, map_gains))
+        if verdict == VERDICT_NEW:
+            novel_actions.append(action)
+        elif verdict == VERDICT_REUSE and on_known_result is not None:
+            on_known_result(action, record)
+    return novel_actions
+
+
 #
 # In the evaluation we try to reduce the dimensions of the input data to a
 # reasonable level. We try to get down to 24 features, because more just makes
-# for an insanely large search space.
+# for an insanely large search space. The number of trajectory points comes
+# from the episode's configuration, 12 by default.
 #
 # If we don't have enough data to generate the 12*2=24 observations, we
 # right-zero-pad the data.
 #
-def evaluate(episode):
-    if len(episode) < 12:
+def evaluate(recorder):
+    n_trajectory = recorder.config.n_trajectory
+    observed_data = recorder.columns(OBSERVED_COLUMNS)
+    if len(recorder) < n_trajectory:
         # either use what we have and zero-pad...
-        observed_data = episode[[COL_CONTROL_VARIABLE, COL_PROCESS_VARIABLE]].reindex(range(12)).fillna(0.0)
+        observed_data = np.vstack((observed_data, np.zeros((n_trajectory - len(recorder), len(OBSERVED_COLUMNS)))))
     else:
         # or take a 'trajectory', as the paper calls it.
-        observed_data = episode.iloc[np.linspace(0, len(episode), 12, endpoint=False)][[COL_CONTROL_VARIABLE, COL_PROCESS_VARIABLE]]
-    observed_data = observed_data.values.flatten().tolist()
+        observed_data = observed_data[np.linspace(0, len(recorder), n_trajectory, endpoint=False).astype(int)]
+    observed_data = observed_data.flatten().tolist()
 
-    error = -(episode[COL_ERROR]**2).sum()
+    error = -(recorder.column(COL_ERROR)**2).sum()
 
     return observed_data, error
 
 #
-# The main driver. Create a supervised plan control and an agent. Prime the
-# learning process, then start running episodes and evaluating these with the
-# auto-tuner.
+# Run the auto-tuner on the supervised plant control, for `n_episodes` or until
+# the program is stopped. Create a supervised plant control and the agents.
+# Prime the learning process, then start running episodes and evaluating these
+# with the auto-tuner. Returns the learning curve: each episode's error and
+# whether the supervisor fell back.
 #
-if __name__ == "__main__":
-    plant_control = PlantControl(IS_HARDWARE, FALLBACK_PID_TUNINGS)
-
-    supervised_plant_control = SupervisedPlantControl(plant_control, BENCHMARK_ERROR, FALLBACK_PID_TUNINGS)
-
-    noisy_agent = NoisyAgent(FALLBACK_PID_TUNINGS)
+def run_autotuner(hyperparameters=HYPERPARAMETERS, n_episodes=None, plant=None, realtime=True,
+                  trace_file=TRACE_FILE, save_episodes=True):
+    map_gains = hyperparameters['map_gains']
+    benchmark_error = hyperparameters['benchmark_error']
+    noisy_episodes = hyperparameters['noisy_episodes']
+    random_episodes = hyperparameters['random_episodes']
+
+    config = EpisodeConfig(EPISODE_T, EPISODE_SAMPLE_RATE, N_TRAJECTORY)
+    plant_control = PlantControl(IS_HARDWARE, FALLBACK_PID_TUNINGS, config.sample_rate,
+                                 plant=plant, realtime=realtime, trace_file=trace_file)
+
+    realtime_mode = RealtimeMode() if REALTIME_MODE and realtime else None
+    telemetry = TelemetryRing(TELEMETRY_NAME) if TELEMETRY_NAME is not None else None
+    supervised_plant_control = SupervisedPlantControl(plant_control, benchmark_error, FALLBACK_PID_TUNINGS, config,
+                                                      end_on_settle=END_ON_SETTLE, realtime_mode=realtime_mode,
+                                                      telemetry=telemetry)
+
+    noisy_agent = NoisyAgent(FALLBACK_PID_TUNINGS, map_gains)
     random_agent = RandomAgent(N_ACTIONS)
-    agent = Agent(alpha=0.00005, beta=0.0005, input_dims=[24], tau=0.001,
-                  batch_size=BATCH_SIZE, layer1_size=400, layer2_size=300, n_actions=N_ACTIONS, max_size=1_000_000)
+    agent = Agent(alpha=hyperparameters['alpha'], beta=hyperparameters['beta'],
+                  input_dims=[config.observation_size], tau=hyperparameters['tau'],
+                  batch_size=hyperparameters['batch_size'],
+                  layer1_size=hyperparameters['layer1_size'], layer2_size=hyperparameters['layer2_size'],
+                  n_actions=N_ACTIONS, max_size=1_000_000, n_threads=LEARN_THREADS,
+                  compile_networks=COMPILE_NETWORKS)
+    bayesian_agent = BayesianAgent(N_ACTIONS)
+
+    # without screening, each agent just proposes the one action
+    screening = CandidateScreening(benchmark_error, supervised_plant_control, SET_POINT)
+    n_candidates = N_CANDIDATES if SCREEN_CANDIDATES else 1
+
+    if USE_TUNING_INDEX:
+        tuning_index = TuningIndex.load(map_gains)
+
+    # the learning agents propose their batch in one go, with their own choice
+    # first, so that screening does not change how they explore
+    def choose_actions():
+        # the Bayesian agent needs no priming, it learns from every episode
+        if USE_BAYESIAN_AGENT:
+            return bayesian_agent.choose_actions(n_candidates)
+        elif episode_nr < noisy_episodes:
+            return [noisy_agent.choose_action() for _ in range(n_candidates)]
+        elif episode_nr < noisy_episodes + random_episodes:
+            return [random_agent.choose_action() for _ in range(n_candidates)]
+        else:
+            return agent.choose_actions(observation, n_candidates)
+
+    # proposals keep landing near the same records, so each one is fed to the
+    # agent only once, lest it count as many observations
+    reused_records = set()
+
+    def reuse_known_result(action, record):
+        key = (record['kp'], record['ki'], record['kd'], record['source'])
+        if key in reused_records:
+            return
+        reused_records.add(key)
+
+        print(f"reusing known error {record['error']:.1f} for PID tunings close to {map_action_to_pid_tunings(action, map_gains)}")
+        if USE_BAYESIAN_AGENT:
+            bayesian_agent.remember(action, -record['error'], False)
+
+    if realtime_mode is not None:
+        realtime_mode.start()
 
     print("generating priming step...")
     pid_tunings = FALLBACK_PID_TUNINGS
-    action = map_pid_tunings_to_action(pid_tunings)
-    episode, _ = supervised_plant_control.step(SET_POINT)
-    observation, _ = evaluate(episode)
+    action = map_pid_tunings_to_action(pid_tunings, map_gains)
+    recorder, _ = supervised_plant_control.step(SET_POINT)
+    observation, _ = evaluate(recorder)
 
+    learning_curve = []
     episode_nr = 0
-    while True:
-        episode, done = supervised_plant_control.step(SET_POINT)
+    while n_episodes is None or episode_nr < n_episodes:
+        try:
+            recorder, done = supervised_plant_control.step(SET_POINT)
+        except EOFError as e:
+            print(f"{e}, stopping after {episode_nr} episodes") # a replayed plant ran out of trace
+            break
 
         if done:
-            timestamp_utc = datetime.utcnow()
-            print(f"saving episode {timestamp_utc.isoformat()}...")
-            save_and_plot_episode(timestamp_utc, episode)
-
-            if episode_nr < 250:
-                action = noisy_agent.choose_action()
-            elif episode_nr < 500:
-                action = random_agent.choose_action()
+            episode = recorder.to_frame()
+            fell_back = (episode[COL_STATE] == STATE_FALLBACK).any()
+            learning_curve.append(((episode[COL_ERROR]**2).sum(), fell_back))
+
+            episode_file = None
+            if save_episodes:
+                timestamp_utc = plant_control.now()
+                print(f"saving episode {timestamp_utc.isoformat()}...")
+                episode_file = save_and_plot_episode(timestamp_utc, episode, plot=plant_control.realtime)
+
+            if USE_BAYESIAN_AGENT:
+                _, episode_reward = evaluate(recorder)
+                bayesian_agent.remember(action, episode_reward, fell_back)
+
+            actions = choose_actions()
+            if USE_TUNING_INDEX:
+                tuning_index.add_episode(episode, episode_file)
+                tuning_index.save()
+
+                # keep proposing until something new comes up, or give up and apply it anyway
+                for _ in range(MAX_PROPOSALS):
+                    novel_actions = filter_known_actions(tuning_index, actions, reuse_known_result, map_gains)
+                    if len(novel_actions) > 0:
+                        actions = novel_actions
+                        break
+                    actions = choose_actions()
+
+            if SCREEN_CANDIDATES:
+                screening.record_outcome(episode)
+                candidate_pid_tunings = [map_action_to_pid_tunings(action, map_gains) for action in actions]
+                action = actions[screening.screen(candidate_pid_tunings, episode)]
+                screening.report()
             else:
-                action = agent.choose_action(observation)
+                action = actions[0]
 
-            pid_tunings = map_action_to_pid_tunings(action)
+            pid_tunings = map_action_to_pid_tunings(action, map_gains)
             supervised_plant_control.set_pid_tunings(pid_tunings)
 
             episode_nr += 1
 
-        new_state, reward = evaluate(episode)
+        new_state, reward = evaluate(recorder)
 
         agent.remember(observation, action, reward, new_state, done)
-        agent.learn()
+        if not LEARN_PER_EPISODE:
+            agent.learn()
+        elif done:
+            agent.learn(n_updates=UPDATES_PER_EPISODE)
 
         observation = new_state
 
+    return learning_curve
+
+
+#
+# The main driver. Pick the plant to run on and run the auto-tuner until the
+# program is stopped.
+#
+if __name__ == "__main__":
+    if METRICS_PORT is not None:
+        metrics.serve_metrics(METRICS_PORT)
+    if METRICS_FILE is not None:
+        metrics.write_metrics(METRICS_FILE)
+
+    if SEED is not None:
+        np.random.seed(SEED)
+        torch.manual_seed(SEED)
+
+    if REPLAY_TRACE_FILE is not None:
+        replay_plant = ReplayPlant(REPLAY_TRACE_FILE)
+        learning_curve = run_autotuner(plant=replay_plant, realtime=False, trace_file=None)
+        print(f"replayed {len(learning_curve)} episodes, {replay_plant.n_diverged} heater settings diverged from the recording")
+    elif FAST_SIMULATION:
+        run_autotuner(plant=ModelPlant(), realtime=False)
+    else:
+        run_autotuner()
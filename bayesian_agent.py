@@ -0,0 +1,135 @@
+#
+# A sample-efficient alternative to the DDPG agent. The agent keeps a Gaussian
+# process over the action space that models the log of the episode error, and
+# a second one that models whether the supervisor fell back. Each episode it
+# proposes the action with the highest expected improvement, weighted by the
+# probability that the supervisor will not have to step in.
+#
+# The kernel's hyperparameters are fixed, so each new observation only extends
+# the Cholesky factor of the kernel matrix instead of refactoring it. We keep
+# the inverse of that factor, so that proposals are plain matrix products and
+# stay cheap as the number of observations grows.
+#
+
+import math
+import numpy as np
+
+
+LENGTH_SCALE = 0.1    # in action space, where each action value is in 0..1
+SIGNAL_VARIANCE = 1.0
+NOISE_VARIANCE = 0.01
+
+N_RANDOM_CANDIDATES = 1000
+N_LOCAL_CANDIDATES = 250
+LOCAL_SCALE = 0.02
+
+normal_cdf = np.vectorize(lambda z: 0.5 * (1.0 + math.erf(z / math.sqrt(2.0))))
+
+
+def normal_pdf(z):
+    return np.exp(-0.5 * z**2) / np.sqrt(2.0 * np.pi)
+
+
+def rbf_kernel(a, b, length_scale=LENGTH_SCALE, signal_variance=SIGNAL_VARIANCE):
+    squared_distance = ((a[:, None, :] - b[None, :, :])**2).sum(axis=2)
+    return signal_variance * np.exp(-0.5 * squared_distance / length_scale**2)
+
+
+#
+# A Gaussian process with a fixed kernel that grows one observation at a time.
+# With $K + \sigma^2 I = L L^T$, adding an observation appends a row to $L$:
+#
+#     L' = [[L, 0], [l^T, d]] with l = L^{-1} k and d = sqrt(k_nn - l^T l)
+#
+# and the inverse of $L'$ follows directly from the inverse of $L$.
+#
+class IncrementalGP:
+    def __init__(self, n_dims, noise_variance=NOISE_VARIANCE):
+        self.noise_variance = noise_variance
+        self.X = np.zeros((0, n_dims))
+        self.y = np.zeros(0)
+        self.L_inv = np.zeros((0, 0))
+
+    def __len__(self):
+        return len(self.y)
+
+    def add(self, x, y):
+        x = np.asarray(x, dtype=float).reshape(1, -1)
+
+        k = rbf_kernel(self.X, x)[:, 0]
+        l = self.L_inv @ k
+        d = math.sqrt(max(rbf_kernel(x, x)[0, 0] + self.noise_variance - l @ l, 1e-12))
+
+        n = len(self.y)
+        L_inv = np.zeros((n + 1, n + 1))
+        L_inv[:n, :n] = self.L_inv
+        L_inv[n, :n] = -(l @ self.L_inv) / d
+        L_inv[n, n] = 1.0 / d
+
+        self.L_inv = L_inv
+        self.X = np.vstack((self.X, x))
+        self.y = np.append(self.y, y)
+
+    # the posterior mean and standard deviation at the given points, for
+    # observations that have the given mean subtracted
+    def predict(self, X, y_mean=0.0):
+        V = self.L_inv @ rbf_kernel(self.X, X)
+        alpha = self.L_inv @ (self.y - y_mean)
+
+        mean = y_mean + V.T @ alpha
+        variance = SIGNAL_VARIANCE - (V**2).sum(axis=0)
+        return mean, np.sqrt(np.maximum(variance, 1e-12))
+
+
+class BayesianAgent:
+    def __init__(self, n_actions):
+        self.n_actions = n_actions
+
+        self.objective = IncrementalGP(n_actions)   # log error, stable episodes only
+        self.constraint = IncrementalGP(n_actions)  # +1 stable, -1 fell back
+
+    #
+    # Record the outcome of an episode. The reward is the negative episode
+    # error, as returned by the driver's `evaluate()`.
+    #
+    def remember(self, action, reward, fell_back):
+        action = np.clip(action, 0.0, 1.0)
+        self.constraint.add(action, -1.0 if fell_back else 1.0)
+        if not fell_back:
+            self.objective.add(action, math.log(max(-reward, 1e-6)))
+
+    def candidates(self):
+        candidates = np.random.rand(N_RANDOM_CANDIDATES, self.n_actions)
+        if len(self.objective) > 0:
+            best = self.objective.X[np.argmin(self.objective.y)]
+            local = best + np.random.normal(0.0, LOCAL_SCALE, size=(N_LOCAL_CANDIDATES, self.n_actions))
+            candidates = np.vstack((candidates, np.clip(local, 0.0, 1.0)))
+        return candidates
+
+    #
+    # Propose the next `n` actions, the best `n` by the constrained expected
+    # improvement, best first. Until we have seen a stable episode, there is
+    # nothing to improve on and we just go for the most likely stable actions.
+    # Before any episode, the proposals are random.
+    #
+    def choose_actions(self, n):
+        candidates = self.candidates()
+        if len(self.constraint) == 0:
+            return list(candidates[:n])
+
+        stable_mean, stable_std = self.constraint.predict(candidates)
+        p_stable = normal_cdf(stable_mean / np.sqrt(stable_std**2 + self.constraint.noise_variance))
+        if len(self.objective) == 0:
+            score = p_stable
+        else:
+            y_mean = self.objective.y.mean()
+            mean, std = self.objective.predict(candidates, y_mean)
+            improvement = self.objective.y.min() - mean
+            z = improvement / std
+            expected_improvement = improvement * normal_cdf(z) + std * normal_pdf(z)
+            score = expected_improvement * p_stable
+
+        return list(candidates[np.argsort(-score, kind='stable')[:n]])
+
+    def choose_action(self):
+        return self.choose_actions(1)[0]
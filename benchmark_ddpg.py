@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# A script to compare the DDPG agent with eager and with compiled networks. It
+# checks that both actors give the same outputs for a batch of observations,
+# then times picking an action for a single observation, and the update
+# throughput of `learn()`. `choose_action()` always runs the eager actor, but we
+# time the compiled actor on a single observation too, to see whether that
+# still holds. Whether compiling pays off depends on the CPU, the number of
+# threads and the layer sizes, so measure before setting `COMPILE_NETWORKS`.
+#
+
+import time
+import numpy as np
+import torch as T
+
+from ddpg_torch import Agent
+from episodes import EpisodeConfig
+from autotuning_supervised_plant_control import HYPERPARAMETERS, N_ACTIONS, LEARN_THREADS
+
+
+N_TRANSITIONS = 10_000
+N_CHOOSE = 2_000
+N_UPDATES = 200
+N_WARMUP = 20
+SEED = 0
+
+
+def make_agent(compile_networks):
+    T.manual_seed(SEED)
+    np.random.seed(SEED)
+    return Agent(alpha=HYPERPARAMETERS['alpha'], beta=HYPERPARAMETERS['beta'],
+                 input_dims=[EpisodeConfig().observation_size], tau=HYPERPARAMETERS['tau'],
+                 batch_size=HYPERPARAMETERS['batch_size'],
+                 layer1_size=HYPERPARAMETERS['layer1_size'], layer2_size=HYPERPARAMETERS['layer2_size'],
+                 n_actions=N_ACTIONS, max_size=N_TRANSITIONS, n_threads=LEARN_THREADS,
+                 compile_networks=compile_networks)
+
+
+def fill_memory(agent, observations):
+    actions = np.random.rand(len(observations), N_ACTIONS)
+    rewards = -np.random.rand(len(observations))
+    for i in range(len(observations)):
+        agent.remember(observations[i], actions[i], rewards[i], observations[i], True)
+
+
+# the actor on one observation at a time, as in `choose_action()`
+def benchmark_choose_action(actor, device, observations):
+    with T.inference_mode():
+        for observation in observations[:N_WARMUP]:
+            actor(T.as_tensor(observation, dtype=T.float, device=device))
+
+        start_time = time.perf_counter()
+        for observation in observations[:N_CHOOSE]:
+            actor(T.as_tensor(observation, dtype=T.float, device=device))
+    return (time.perf_counter() - start_time) / N_CHOOSE
+
+
+def benchmark_learn(agent):
+    agent.learn(n_updates=N_WARMUP)
+    agent.learn(n_updates=N_UPDATES)
+    return agent.updates_per_second
+
+
+if __name__ == "__main__":
+    observations = np.random.rand(N_TRANSITIONS, EpisodeConfig().observation_size)
+
+    eager = make_agent(compile_networks=False)
+    start_time = time.perf_counter()
+    compiled = make_agent(compile_networks=True)
+    compile_time = time.perf_counter() - start_time
+
+    # with the same seed, both start out with the same weights
+    with T.inference_mode():
+        states = T.as_tensor(observations[:N_CHOOSE], dtype=T.float, device=eager.actor.device)
+        difference = (eager.actor_forward(states) - compiled.actor_forward(states)).abs().max().item()
+    print(f"largest difference in actor outputs over {N_CHOOSE} observations: {difference:.3g}")
+    print(f"compiling took {compile_time:.1f} seconds")
+
+    results = {}
+    for name, agent, actor in [('eager', eager, eager.actor), ('compiled', compiled, compiled.actor_forward)]:
+        fill_memory(agent, observations)
+        results[name] = (benchmark_choose_action(actor, agent.actor.device, observations), benchmark_learn(agent))
+
+    for name, (choose_action_time, updates_per_second) in results.items():
+        print(f"{name + ':':10s} choose_action() {choose_action_time * 1e6:.1f} us, learn() {updates_per_second:.1f} updates/sec")
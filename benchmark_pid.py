@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#
+# A script to check our own PID controller against `simple_pid`, step for step,
+# and to compare how long each takes per step. Both controllers run on the
+# same, noisy input with a fixed `dt`, and both see the same tuning changes and
+# resets that the supervisor would make.
+#
+
+import time
+import numpy as np
+from simple_pid import PID as SimplePID
+
+from pid import PID
+
+
+N_STEPS = 100_000
+DT = 0.5
+SET_POINT = 23.0
+TUNINGS = [(50.0, 0.001, 0.1), (20.0, 0.1, 0.01), (400.0, 40.0, 4.0)]
+
+
+def validate(inputs):
+    ours = PID(*TUNINGS[0], setpoint=SET_POINT, dt=DT)
+    theirs = SimplePID(*TUNINGS[0], setpoint=SET_POINT, sample_time=None)
+
+    max_difference = 0.0
+    for t, y in enumerate(inputs):
+        # change tunings every so often, as `PlantControl.set_pid_tunings()` does
+        if t % 600 == 0:
+            tunings = TUNINGS[(t // 600) % len(TUNINGS)]
+            ours.tunings = tunings
+            ours.reset()
+            theirs.tunings = tunings
+            theirs.reset()
+
+        difference = abs(ours(y) - theirs(y, dt=DT))
+        state_difference = np.abs(np.subtract(ours.state(),
+                                              theirs.tunings + theirs.components + (theirs._last_error,))).max()
+        max_difference = max(max_difference, difference, state_difference)
+
+    return max_difference
+
+
+def benchmark(controller, inputs, **kwargs):
+    start_time = time.perf_counter()
+    for y in inputs:
+        controller(y, **kwargs)
+    return (time.perf_counter() - start_time) / len(inputs)
+
+
+if __name__ == "__main__":
+    inputs = (SET_POINT + np.random.normal(0.0, 1.0, N_STEPS)).tolist()
+
+    print(f"largest difference in output or state over {N_STEPS} steps: {validate(inputs):.3g}")
+
+    ours = benchmark(PID(*TUNINGS[0], setpoint=SET_POINT, dt=DT), inputs)
+    theirs = benchmark(SimplePID(*TUNINGS[0], setpoint=SET_POINT, sample_time=None), inputs, dt=DT)
+    print(f"pid.PID:        {ours * 1e6:.2f} us per step")
+    print(f"simple_pid.PID: {theirs * 1e6:.2f} us per step")
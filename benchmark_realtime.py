@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# A script to measure what the real-time mode does for the cycle latency. It
+# runs the supervised plant control in real time on the plant model, first as
+# is and then in real-time mode, and reports how late the cycles started. To
+# provoke collections, each step leaves cyclic garbage behind, much like the
+# auto-tuner's DataFrames, tensors and plots do.
+#
+
+import gc
+
+from episodes import EpisodeConfig
+from plant_control import PlantControl, LATENCY_PERCENTILES
+from plant_model import ModelPlant
+from realtime import RealtimeMode
+from supervised_plant_control import SupervisedPlantControl, FALLBACK_PID_TUNINGS, BENCHMARK_ERROR, SET_POINT
+
+
+CONFIG = EpisodeConfig(T=10, sample_rate=50)
+N_EPISODES = 2
+GARBAGE_PER_STEP = 2_000
+LONG_LIVED_OBJECTS = 500_000 # like the replay buffer's and agents' objects
+
+
+class Node:
+    def __init__(self):
+        self.other = self
+
+
+def run(realtime_mode):
+    plant_control = PlantControl(False, FALLBACK_PID_TUNINGS, CONFIG.sample_rate, plant=ModelPlant())
+    supervised_plant_control = SupervisedPlantControl(plant_control, BENCHMARK_ERROR, FALLBACK_PID_TUNINGS, CONFIG,
+                                                      realtime_mode=realtime_mode)
+    if realtime_mode is not None:
+        realtime_mode.start()
+
+    for _ in range(N_EPISODES * CONFIG.episode_length):
+        supervised_plant_control.step(SET_POINT)
+        garbage = [Node() for _ in range(GARBAGE_PER_STEP)]
+
+    return plant_control.cycle_latency()
+
+
+if __name__ == "__main__":
+    long_lived = [{'value': i} for i in range(LONG_LIVED_OBJECTS)]
+
+    gc.collect()
+    results = {'as is': run(None), 'real-time mode': run(RealtimeMode())}
+
+    print()
+    print(f"cycle latency over {N_EPISODES * CONFIG.episode_length} cycles of {1000 / CONFIG.sample_rate:.0f} ms:")
+    for name, latencies in results.items():
+        print(f"{name + ':':16s}" + ", ".join(f"p{p:g} {latency * 1000:.2f} ms" for p, latency in zip(LATENCY_PERCENTILES, latencies)))
@@ -0,0 +1,92 @@
+#
+# A screening stage between the agents and the supervised plant control. Many
+# of the proposed PID tunings trip the supervisor within seconds, wasting a live
+# episode each time. Instead of applying a single proposal, the driver has the
+# agent propose a batch of candidates. The screening stage runs them all on the
+# plant model and forwards only the most promising candidate, preferring those
+# that are predicted to stay under the benchmark error $R_{bmk}$.
+#
+# The first candidate in each batch is what the agent would have applied
+# without screening. That gives us a way to tell how many live fall-backs the
+# screening avoided: the agent's own choice was predicted to trip the
+# supervisor, while the forwarded candidate ran its live episode without
+# falling back.
+#
+# The candidates are simulated with the episode configuration that the next
+# live episode runs with, as the supervisor has it at screening time.
+#
+
+import numpy as np
+
+from episodes import COL_PROCESS_VARIABLE, COL_SECONDARY_PROCESS_VARIABLE, COL_STATE, STATE_FALLBACK
+from plant_model import TA, simulate_episodes, predict_fallback
+
+
+class CandidateScreening:
+    def __init__(self, R_bmk, supervisor, setpoint):
+        self.R_bmk = R_bmk
+        self.supervisor = supervisor
+        self.setpoint = setpoint
+
+        self.n_screened = 0
+        self.n_forwarded_safe = 0
+        self.n_first_choice_unsafe = 0
+        self.n_live_fallbacks = 0
+        self.n_avoided = 0
+
+        self.pending = None
+
+
+    #
+    # Pick one of the candidate PID tunings. The simulation starts from the
+    # temperatures at the end of the previous episode, because that is where
+    # the next episode will start from too. Returns the index of the chosen
+    # candidate.
+    #
+    def screen(self, candidate_pid_tunings, previous_episode=None):
+        y0, y2_0 = TA, TA
+        if previous_episode is not None and len(previous_episode) > 0:
+            y0 = previous_episode[COL_PROCESS_VARIABLE].iloc[-1]
+            y2_0 = previous_episode[COL_SECONDARY_PROCESS_VARIABLE].iloc[-1]
+
+        errors = simulate_episodes(candidate_pid_tunings, self.supervisor.proposed_config, self.setpoint, y0, y2_0)
+        running_error, fallback_step = predict_fallback(errors, self.R_bmk)
+        is_safe = fallback_step == errors.shape[1]
+
+        # safe candidates rank by their error, the others by how long they last
+        if is_safe.any():
+            chosen = int(np.argmin(np.where(is_safe, running_error, np.inf)))
+        else:
+            chosen = int(np.argmax(fallback_step))
+
+        self.n_screened += 1
+        self.n_forwarded_safe += int(is_safe[chosen])
+        self.n_first_choice_unsafe += int(not is_safe[0])
+        self.pending = (bool(is_safe[0]), bool(is_safe[chosen]))
+
+        print(f"screened {len(is_safe)} candidates, {is_safe.sum()} predicted safe, forwarding "
+              f"{tuple(np.round(candidate_pid_tunings[chosen], 4).tolist())} with predicted error {running_error[chosen]:.1f}")
+        return chosen
+
+
+    #
+    # Record the live outcome of the episode that ran the last forwarded
+    # candidate.
+    #
+    def record_outcome(self, episode):
+        if self.pending is None:
+            return
+
+        first_choice_safe, chosen_safe = self.pending
+        self.pending = None
+
+        fell_back = (episode[COL_STATE] == STATE_FALLBACK).any()
+        self.n_live_fallbacks += int(fell_back)
+        if not first_choice_safe and chosen_safe and not fell_back:
+            self.n_avoided += 1
+
+
+    def report(self):
+        print(f"screening: {self.n_screened} episodes screened, {self.n_forwarded_safe} forwarded predicted-safe, "
+              f"{self.n_first_choice_unsafe} first choices predicted to fall back, "
+              f"{self.n_live_fallbacks} live fall-backs, {self.n_avoided} live fall-backs avoided")
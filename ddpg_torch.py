@@ -1,10 +1,20 @@
 import os
+import time
 import torch as T
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import numpy as np
 
+import metrics
+
+REPLAY_BUFFER_FILL = metrics.gauge('learner_replay_buffer_fill', 'Fraction of the replay buffer in use')
+LEARN_STEPS_PER_SECOND = metrics.gauge('learner_steps_per_second', 'Update throughput of the last learn call')
+ACTOR_LOSS = metrics.gauge('learner_actor_loss', 'Actor loss of the last update')
+CRITIC_LOSS = metrics.gauge('learner_critic_loss', 'Critic loss of the last update')
+
+COMPILE_TOLERANCE = 1e-5
+
 class OUActionNoise:
     def __init__(self, mu, sigma=0.15, theta=0.2, dt=1e-2):
         self.mu = mu
@@ -20,6 +30,11 @@ class OUActionNoise:
         self.x_prev = x
         return x
 
+    # independent draws from the stationary distribution of the process,
+    # without advancing it
+    def sample(self, n):
+        return np.abs(self.mu + self.sigma / np.sqrt(2 * self.theta) * np.random.normal(size=(n, *self.mu.shape)))
+
 
 class ReplayBuffer:
     def __init__(self, max_size, input_shape, n_actions):
@@ -53,6 +68,18 @@ class ReplayBuffer:
 
         return states, actions, rewards, new_states, terminal
 
+    # draw `n_batches` batches at once, as a single contiguous float32 block of
+    # shape (n_batches, batch_size, state + action + reward + new state + terminal)
+    def sample_batches(self, batch_size, n_batches):
+        max_mem = min(self.mem_cntr, self.mem_size)
+        batch = np.random.randint(0, max_mem, size=(n_batches, batch_size))
+
+        return np.concatenate((self.state_memory[batch],
+                               self.action_memory[batch],
+                               self.reward_memory[batch][..., None],
+                               self.new_state_memory[batch],
+                               self.terminal_memory[batch][..., None]), axis=2, dtype=np.float32)
+
 class CriticNetwork(nn.Module):
     def __init__(self, beta, input_dims, fc1_dims, fc2_dims, n_actions, name):
         super(CriticNetwork, self).__init__()
@@ -166,12 +193,41 @@ class ActorNetwork(nn.Module):
         print(f"loading {checkpoint_file}")
 
 
+#
+# Compile a network with `torch.compile`, to cut the Python overhead per call on
+# these small networks. The compiled network shares its parameters with the
+# eager one, so the optimisers, the soft updates and the checkpoints keep
+# working on the eager network. Compiling is lazy, so we run the example inputs
+# through it, forward and backward, and check the result against eager mode.
+# If anything fails, or the results disagree, we fall back to eager mode.
+#
+def compile_network(network, *example_inputs):
+    try:
+        compiled = T.compile(network, dynamic=False)
+        expected = network(*example_inputs)
+        actual = compiled(*example_inputs)
+        actual.sum().backward()
+        network.zero_grad(set_to_none=True)
+        if T.allclose(actual, expected, atol=COMPILE_TOLERANCE):
+            return compiled
+        print(f"compiled {network.name} disagrees with eager mode, running {network.name} eager")
+    except Exception as e:
+        print(f"failed to compile {network.name}, running it eager: {e}")
+    network.zero_grad(set_to_none=True)
+    return network
+
+
 class Agent:
     def __init__(self, alpha, beta, input_dims, tau, gamma=0.99, n_actions=2,
-                 max_size=1000000, layer1_size=400, layer2_size=300, batch_size=64):
+                 max_size=1000000, layer1_size=400, layer2_size=300, batch_size=64, n_threads=None,
+                 compile_networks=False):
         self.gamma = gamma
         self.tau = tau
         self.batch_size = batch_size
+        self.input_dims = input_dims
+        self.n_actions = n_actions
+        self.n_threads = n_threads
+        self.updates_per_second = None
 
         self.memory = ReplayBuffer(max_size, input_dims, n_actions)
 
@@ -189,83 +245,130 @@ class Agent:
 
         self.update_network_parameters(tau=1)
 
+        # the networks as called in `update()`, compiled or not; the networks
+        # themselves stay eager
+        self.actor_forward = self.actor
+        self.target_actor_forward = self.target_actor
+        self.critic_forward = self.critic
+        self.target_critic_forward = self.target_critic
+        if compile_networks:
+            self.compile_networks()
+
+    def compile_networks(self):
+        state = T.rand(self.batch_size, *self.input_dims, device=self.actor.device)
+        action = T.rand(self.batch_size, self.n_actions, device=self.actor.device)
+
+        self.actor_forward = compile_network(self.actor, state)
+        self.target_actor_forward = compile_network(self.target_actor, state)
+        self.critic_forward = compile_network(self.critic, state, action)
+        self.target_critic_forward = compile_network(self.target_critic, state, action)
+
+    # no autograd for picking an action; layer normalisation behaves the same
+    # in training and evaluation mode, so there is no need to switch modes. A
+    # single observation runs eager: compiled, it only adds overhead.
     def choose_action(self, observation):
-        self.actor.eval()
-        observation = T.tensor(observation, dtype=T.float).to(self.actor.device)
-        mu = self.actor.forward(observation).to(self.actor.device)
-        mu_prime = mu + T.tensor(self.noise(), dtype=T.float).to(self.actor.device)
-        self.actor.train()
-        return mu_prime.cpu().detach().numpy()
+        with T.inference_mode():
+            observation = T.as_tensor(observation, dtype=T.float, device=self.actor.device)
+            mu = self.actor(observation)
+            mu_prime = mu + T.as_tensor(self.noise(), dtype=T.float, device=self.actor.device)
+        return mu_prime.cpu().numpy()
+
+    # a batch of `n` candidate actions, for screening. The first is what
+    # `choose_action()` would have picked; the others add independent noise to
+    # the same `mu`, so they leave the exploration noise where it was.
+    def choose_actions(self, observation, n):
+        with T.inference_mode():
+            observation = T.as_tensor(observation, dtype=T.float, device=self.actor.device)
+            mu = self.actor(observation).cpu().numpy()
+        return [mu + self.noise(), *(mu + self.noise.sample(n - 1))]
 
     def remember(self, state, action, reward, new_state, done):
         self.memory.store_transition(state, action, reward, new_state, done)
-
-    def learn(self):
+        REPLAY_BUFFER_FILL.set(min(self.memory.mem_cntr, self.memory.mem_size) / self.memory.mem_size)
+
+    #
+    # Learn from `n_updates` batches. All batches are drawn in one go and moved
+    # to the device as a single block, so that one call between episodes can do
+    # the work of many per-step calls without the per-call overhead.
+    #
+    def learn(self, n_updates=1):
+        if n_updates < 1:
+            return
         if self.memory.mem_cntr < self.batch_size:
             print(f"{self.memory.mem_cntr} is not enough samples, not learning until we have {self.batch_size}...")
             return
 
-        state, action, reward, new_state, done = self.memory.sample_buffer(self.batch_size)
-        state = T.tensor(state, dtype=T.float).to(self.critic.device)
-        action = T.tensor(action, dtype=T.float).to(self.critic.device)
-        reward = T.tensor(reward, dtype=T.float).to(self.critic.device)
-        new_state = T.tensor(new_state, dtype=T.float).to(self.critic.device)
-        done = T.tensor(done, dtype=T.float).to(self.critic.device)
-
-        self.target_actor.eval()
-        self.critic.eval()
-        self.target_critic.eval()
+        start_time = time.perf_counter()
+        previous_n_threads = T.get_num_threads()
+        if self.n_threads is not None:
+            T.set_num_threads(self.n_threads)
+
+        try:
+            block = T.from_numpy(self.memory.sample_batches(self.batch_size, n_updates))
+            if self.critic.device.type == 'cuda':
+                block = block.pin_memory()
+            block = block.to(self.critic.device, non_blocking=True)
+
+            n_states = self.input_dims[0]
+            state     = block[:, :, :n_states]
+            action    = block[:, :, n_states:n_states + self.n_actions]
+            reward    = block[:, :, n_states + self.n_actions:n_states + self.n_actions + 1]
+            new_state = block[:, :, n_states + self.n_actions + 1:-1]
+            done      = block[:, :, -1:]
+
+            # our networks use layer normalisation, which behaves the same in
+            # training and evaluation mode, so we set the modes once per call
+            self.target_actor.eval()
+            self.target_critic.eval()
+            self.actor.train()
+            self.critic.train()
+
+            for k in range(n_updates):
+                actor_loss, critic_loss = self.update(state[k], action[k], reward[k], new_state[k], done[k])
+        finally:
+            T.set_num_threads(previous_n_threads)
+
+        self.updates_per_second = n_updates / (time.perf_counter() - start_time)
+        LEARN_STEPS_PER_SECOND.set(self.updates_per_second)
+        ACTOR_LOSS.set(actor_loss.item())
+        CRITIC_LOSS.set(critic_loss.item())
+        if n_updates > 1:
+            print(f"learnt from {n_updates} batches of {self.batch_size}, {self.updates_per_second:.1f} updates/sec")
+
+    def update(self, state, action, reward, new_state, done):
+        with T.no_grad():
+            target_actions = self.target_actor_forward(new_state)
+            target_critic_value = self.target_critic_forward(new_state, target_actions)
+            target = reward + self.gamma * target_critic_value * done
+
+        critic_value = self.critic_forward(state, action)
 
-        target_actions = self.target_actor.forward(new_state)
-        target_critic_value = self.target_critic.forward(new_state, target_actions)
-        critic_value = self.critic.forward(state, action)
-
-        target = []
-        for j in range(self.batch_size):
-            target.append(reward[j] + self.gamma * target_critic_value[j] * done[j])
-        target = T.tensor(target).to(self.critic.device)
-        target = target.view(self.batch_size, 1)
-
-        self.critic.train()
         self.critic.optimizer.zero_grad()
         critic_loss = F.mse_loss(target, critic_value)
         critic_loss.backward()
         self.critic.optimizer.step()
 
-        self.critic.eval()
         self.actor.optimizer.zero_grad()
-        mu = self.actor.forward(state)
-        self.actor.train()
-        actor_loss = -self.critic.forward(state, mu)
+        mu = self.actor_forward(state)
+        actor_loss = -self.critic_forward(state, mu)
         actor_loss = T.mean(actor_loss)
         actor_loss.backward()
         self.actor.optimizer.step()
 
         self.update_network_parameters()
 
+        return actor_loss.detach(), critic_loss.detach()
+
     def update_network_parameters(self, tau=None):
         if tau is None:
             tau = self.tau
 
-        actor_parameters = self.actor.named_parameters()
-        critic_parameters = self.critic.named_parameters()
-        target_actor_parameters = self.target_actor.named_parameters()
-        target_critic_parameters = self.target_critic.named_parameters()
-
-        actor_state_dict = dict(actor_parameters)
-        critic_state_dict = dict(critic_parameters)
-        target_actor_state_dict = dict(target_actor_parameters)
-        target_critic_state_dict = dict(target_critic_parameters)
-
-        for name in actor_state_dict:
-            actor_state_dict[name] = tau     * actor_state_dict[name].clone() + \
-                                     (1-tau) * target_actor_state_dict[name].clone()
-        self.target_actor.load_state_dict(actor_state_dict)
-
-        for name in critic_state_dict:
-            critic_state_dict[name] = tau    * critic_state_dict[name].clone() + \
-                                     (1-tau) * target_critic_state_dict[name].clone()
-        self.target_critic.load_state_dict(critic_state_dict)
+        # soft update, in place: target = tau * network + (1 - tau) * target
+        with T.no_grad():
+            for parameter, target_parameter in zip(self.actor.parameters(), self.target_actor.parameters()):
+                target_parameter.lerp_(parameter, tau)
+            for parameter, target_parameter in zip(self.critic.parameters(), self.target_critic.parameters()):
+                target_parameter.lerp_(parameter, tau)
 
     def save_models(self, checkpoint_dir):
         os.makedirs(checkpoint_dir, exist_ok=True)
@@ -3,7 +3,11 @@
 #
 
 import os
+import json
 import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import matplotlib.pyplot as plt
 
 #
@@ -51,15 +55,105 @@ STATE_FALLBACK = 1
 T = 300                          # nominal episodes are 5 minutes, or 300 seconds.
 SAMPLE_RATE = 2 # Hz             # the hardware samples take varying times, but anything under ~2.5 Hz looks safe
 EPISODE_LENGTH = T * SAMPLE_RATE # Multiply by sample rate to get the episode and data frame size.
+N_TRAJECTORY = 12                # points sampled from each observed variable's trajectory
+
+OBSERVED_COLUMNS = [COL_CONTROL_VARIABLE, COL_PROCESS_VARIABLE]
 
 SAVE_DIR = "episodes"
+METADATA_KEY = b'episode'
 
 
 #
-# Save an episode in an easily retrievable format.
+# The values above are the defaults. Episode length, sample rate and
+# observation size may differ per run, so that (say) short screening runs and
+# full-length confirmation runs can share one pipeline and one archive. Each
+# episode data frame carries its configuration in its `attrs`, and that
+# configuration is saved alongside the data.
+#
+class EpisodeConfig:
+    def __init__(self, T=T, sample_rate=SAMPLE_RATE, n_trajectory=N_TRAJECTORY):
+        self.T = T
+        self.sample_rate = sample_rate
+        self.n_trajectory = n_trajectory
+
+        self.episode_length = int(T * sample_rate)
+        self.observation_size = n_trajectory * len(OBSERVED_COLUMNS)
+
+    def to_metadata(self):
+        return {'T': self.T, 'sample_rate': self.sample_rate, 'n_trajectory': self.n_trajectory}
+
+    @staticmethod
+    def from_metadata(metadata):
+        return EpisodeConfig(**metadata)
+
+    # episodes created before the configuration was recorded get the defaults
+    @staticmethod
+    def of(_df):
+        return EpisodeConfig.from_metadata(_df.attrs.get('episode', {}))
+
+    def __repr__(self):
+        return f"EpisodeConfig(T={self.T}, sample_rate={self.sample_rate}, n_trajectory={self.n_trajectory})"
+
+
+#
+# Records an episode step by step into a preallocated array, one row per step
+# in the order of `EPISODE_COLUMNS`. The plant control writes each step's values
+# straight into the next row. Turn the recording into a data frame, tagged with
+# its configuration, with `to_frame()`.
+#
+class EpisodeRecorder:
+    def __init__(self, config):
+        self.config = config
+        self.data = np.zeros((config.episode_length + 1, len(EPISODE_COLUMNS)))
+        self.n_steps = 0
+
+    def __len__(self):
+        return self.n_steps
+
+    def next_row(self):
+        row = self.data[self.n_steps]
+        self.n_steps += 1
+        return row
+
+    def column(self, column):
+        return self.data[:self.n_steps, EPISODE_COLUMNS.index(column)]
+
+    # a copy of the given columns, in that order
+    def columns(self, columns):
+        return self.data[:self.n_steps, [EPISODE_COLUMNS.index(column) for column in columns]]
+
+    def to_frame(self):
+        _df = pd.DataFrame(self.data[:self.n_steps], columns=EPISODE_COLUMNS)
+        _df[COL_STATE] = _df[COL_STATE].astype(int)
+        _df.attrs['episode'] = self.config.to_metadata()
+        return _df
+
+
+#
+# Save an episode in an easily retrievable format. We go through PyArrow
+# directly, so that we can store the episode configuration in the Parquet
+# schema metadata.
 #
 def save_episode(_df, save_file):
-    _df.to_parquet(save_file)
+    table = pa.Table.from_pandas(_df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[METADATA_KEY] = json.dumps(EpisodeConfig.of(_df).to_metadata())
+    pq.write_table(table.replace_schema_metadata(metadata), save_file)
+
+
+#
+# Load an episode, restoring its configuration into the data frame's `attrs`.
+#
+def load_episode(save_file):
+    table = pq.read_table(save_file)
+    _df = table.to_pandas()
+
+    metadata = table.schema.metadata or {}
+    if METADATA_KEY in metadata:
+        _df.attrs['episode'] = json.loads(metadata[METADATA_KEY])
+    else:
+        _df.attrs['episode'] = EpisodeConfig().to_metadata()
+    return _df
 
 
 #
@@ -71,7 +165,12 @@ def save_episode(_df, save_file):
 # controller.
 #
 def plot_episode(_df, plot_file):
-    to_fallback = np.searchsorted(_df[COL_STATE], STATE_FALLBACK) / SAMPLE_RATE
+    # episodes may be cut short, so we shade up to the last step, not up to T
+    fallback_index = np.searchsorted(_df[COL_STATE], STATE_FALLBACK)
+    has_fallback = fallback_index < len(_df)
+    if has_fallback:
+        to_fallback = _df[COL_TIME].iloc[fallback_index]
+        end_time = _df[COL_TIME].iloc[-1]
 
     plt.rcParams['lines.linewidth'] = 0.8
     fig, axes = plt.subplot_mosaic("TTT;TTT;HHH;HHH;PID", figsize=(15,10))
@@ -83,8 +182,8 @@ def plot_episode(_df, plot_file):
     axes['T'].plot(_df[COL_TIME], _df[COL_PROCESS_VARIABLE],           'b',  label=COL_PROCESS_VARIABLE)
     axes['T'].plot(_df[COL_TIME], _df[COL_SECONDARY_PROCESS_VARIABLE], 'g:', label=COL_SECONDARY_PROCESS_VARIABLE)
     axes['T'].plot(_df[COL_TIME], _df[COL_ERROR],                      'r',  label=error_label)
-    if to_fallback < T:
-        axes['T'].axvspan(to_fallback, T, facecolor='peachpuff', alpha=0.3)
+    if has_fallback:
+        axes['T'].axvspan(to_fallback, end_time, facecolor='peachpuff', alpha=0.3)
     axes['T'].set_ylabel(r'temperature $(^oC)$')
     axes['T'].legend(loc='upper right')
 
@@ -94,8 +193,8 @@ def plot_episode(_df, plot_file):
     axes['H'].plot(_df[COL_TIME], _df[COL_CONTROL_VARIABLE],             'b',   label=COL_CONTROL_VARIABLE)
     axes['H'].plot(_df[COL_TIME], _df[COL_DISTURBANCE_CONTROL_VARIABLE], 'g:',  label=COL_DISTURBANCE_CONTROL_VARIABLE)
     axes['H'].text(2, 10, f"$(K_p, K_i, K_d) = ({_df[COL_KP][0]}, {_df[COL_KI][0]}, {_df[COL_KD][0]})$", rotation=90, fontsize='xx-small')
-    if to_fallback < T:
-        axes['H'].axvspan(to_fallback, T, facecolor='peachpuff', alpha=0.3)
+    if has_fallback:
+        axes['H'].axvspan(to_fallback, end_time, facecolor='peachpuff', alpha=0.3)
         axes['H'].text(to_fallback + 2, 10, f"$(K_p, K_i, K_d) = ({_df.at[_df.index[-1], COL_KP]}, {_df.at[_df.index[-1], COL_KI]}, {_df.at[_df.index[-1], COL_KD]})$", rotation=90, fontsize='xx-small')
     axes['H'].set_ylabel('heater $(\%)$')
     axes['H'].set_ylim((-50.0, 150.0))
@@ -103,20 +202,20 @@ def plot_episode(_df, plot_file):
 
     axes['P'].axhline(y=0.0, color='grey', linestyle=':', alpha=0.5)
     axes['P'].plot(_df[COL_TIME], _df[COL_INTERNAL_PROPORTIONAL], label=COL_INTERNAL_PROPORTIONAL)
-    if to_fallback < T:
-        axes['P'].axvspan(to_fallback, T, facecolor='peachpuff', alpha=0.3)
+    if has_fallback:
+        axes['P'].axvspan(to_fallback, end_time, facecolor='peachpuff', alpha=0.3)
     axes['P'].legend(loc='upper right')
 
     axes['I'].axhline(y=0.0, color='grey', linestyle=':', alpha=0.5)
     axes['I'].plot(_df[COL_TIME], _df[COL_INTERNAL_INTEGRAL],     label=COL_INTERNAL_INTEGRAL)
-    if to_fallback < T:
-        axes['I'].axvspan(to_fallback, T, facecolor='peachpuff', alpha=0.3)
+    if has_fallback:
+        axes['I'].axvspan(to_fallback, end_time, facecolor='peachpuff', alpha=0.3)
     axes['I'].legend(loc='upper right')
 
     axes['D'].axhline(y=0.0, color='grey', linestyle=':', alpha=0.5)
     axes['D'].plot(_df[COL_TIME], _df[COL_INTERNAL_DERIVATIVE],   label=COL_INTERNAL_DERIVATIVE)
-    if to_fallback < T:
-        axes['D'].axvspan(to_fallback, T, facecolor='peachpuff', alpha=0.3)
+    if has_fallback:
+        axes['D'].axvspan(to_fallback, end_time, facecolor='peachpuff', alpha=0.3)
     axes['D'].legend(loc='upper right')
 
     plt.savefig(plot_file)
@@ -124,12 +223,17 @@ def plot_episode(_df, plot_file):
 
 
 #
-# Save and plot an episode.
+# Save and plot an episode. Plotting takes much longer than a simulated
+# episode, so fast runs may skip it. Returns the file the episode was saved to.
 #
-def save_and_plot_episode(timestamp_utc, episode):
+def save_and_plot_episode(timestamp_utc, episode, plot=True):
     os.makedirs(SAVE_DIR, exist_ok=True)
 
     basename = timestamp_utc.isoformat().replace(':', '')
-    save_episode(episode, f"{SAVE_DIR}/{basename}Z.parquet")
-    plot_episode(episode, f"{SAVE_DIR}/{basename}Z.png")
+    save_file = f"{SAVE_DIR}/{basename}Z.parquet"
+    save_episode(episode, save_file)
+    if plot:
+        plot_episode(episode, f"{SAVE_DIR}/{basename}Z.png")
+
+    return save_file
 
@@ -0,0 +1,161 @@
+#
+# A lightweight metrics surface for the control loop and the learner. Metrics
+# are counters, gauges and histograms that live in memory. Updating a metric
+# is a plain attribute update, without locks, so that the control loop pays
+# next to nothing for them. Each metric has a single writer: the loop that owns
+# it. Readers render a snapshot in the OpenMetrics text format, either from a
+# local HTTP endpoint or into a file that is replaced with each snapshot.
+#
+
+import os
+import time
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+START_TIME = time.time()
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return [f"# TYPE {self.name} counter",
+                f"# HELP {self.name} {self.help}",
+                f"{self.name}_total {self.value}"]
+
+
+class Gauge:
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.value = 0.0
+        self.function = function # computed when rendering, if given
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        value = self.function() if self.function is not None else self.value
+        return [f"# TYPE {self.name} gauge",
+                f"# HELP {self.name} {self.help}",
+                f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = [f"# TYPE {self.name} histogram",
+                 f"# HELP {self.name} {self.help}"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+#
+# The registry of all metrics in this process. Modules register their metrics
+# when they are imported.
+#
+REGISTRY = {}
+
+def register(metric):
+    return REGISTRY.setdefault(metric.name, metric)
+
+def counter(name, help):
+    return register(Counter(name, help))
+
+def gauge(name, help, function=None):
+    return register(Gauge(name, help, function))
+
+def histogram(name, help, buckets):
+    return register(Histogram(name, help, buckets))
+
+
+def hours_running():
+    return (time.time() - START_TIME) / 3600.0
+
+
+def render():
+    lines = []
+    for metric in list(REGISTRY.values()):
+        lines.extend(metric.render())
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # keep the control loop's output readable
+
+
+#
+# Serve the metrics from a local HTTP endpoint, on a daemon thread.
+#
+def serve_metrics(port, address='127.0.0.1'):
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    print(f"serving metrics on http://{address}:{port}/metrics")
+    return server
+
+
+#
+# Write a metrics snapshot to a file every `interval` seconds, on a daemon
+# thread. Each snapshot replaces the file as a whole, so that a reader never
+# sees a partly written exposition. The previous `backup_count` snapshots are kept
+# as `<file>.1`, `<file>.2` and so on, the most recent first.
+#
+def write_metrics(metrics_file, interval=10.0, backup_count=3):
+    def rotate():
+        for i in range(backup_count - 1, 0, -1):
+            if os.path.exists(f"{metrics_file}.{i}"):
+                os.replace(f"{metrics_file}.{i}", f"{metrics_file}.{i + 1}")
+        if backup_count > 0 and os.path.exists(metrics_file):
+            os.replace(metrics_file, f"{metrics_file}.1")
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with open(f"{metrics_file}.tmp", 'w') as f:
+                f.write(render())
+            rotate()
+            os.replace(f"{metrics_file}.tmp", metrics_file)
+
+    threading.Thread(target=run, name='metrics-file', daemon=True).start()
+    print(f"writing metrics to {metrics_file} every {interval} seconds")
@@ -0,0 +1,57 @@
+#
+# A lean PID controller for the control loop's hot path. It follows `simple_pid`
+# as `PlantControl` used it: proportional on error, derivative on measurement
+# and no output limits, so that we can cap $u(t)$ ourselves. Unlike
+# `simple_pid`, it does not read a clock. The control loop runs at a fixed
+# cycle time and passes that in as `dt`.
+#
+# The internal state is public, so that the plant control can record it
+# without reaching into private attributes.
+#
+
+class PID:
+    __slots__ = ('Kp', 'Ki', 'Kd', 'setpoint', 'dt',
+                 'proportional', 'integral', 'derivative', 'last_input', 'last_error')
+
+    def __init__(self, Kp=1.0, Ki=0.0, Kd=0.0, setpoint=0.0, dt=1.0):
+        self.Kp, self.Ki, self.Kd = Kp, Ki, Kd
+        self.setpoint = setpoint
+        self.dt = dt
+        self.last_error = 0.0
+        self.reset()
+
+    @property
+    def tunings(self):
+        return self.Kp, self.Ki, self.Kd
+
+    @tunings.setter
+    def tunings(self, tunings):
+        self.Kp, self.Ki, self.Kd = tunings
+
+    # like `simple_pid`, a reset clears the terms and the derivative history,
+    # but keeps the last error.
+    def reset(self):
+        self.proportional = 0.0
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.last_input = None
+
+    def __call__(self, input_):
+        error = self.setpoint - input_
+        d_input = input_ - self.last_input if self.last_input is not None else 0.0
+
+        # without output limits, there is no clamping of the integral term
+        self.proportional = self.Kp * error
+        self.integral += self.Ki * error * self.dt
+        self.derivative = -self.Kd * d_input / self.dt
+
+        self.last_input = input_
+        self.last_error = error
+        return self.proportional + self.integral + self.derivative
+
+    # the gains, the terms and the error, in the order of the episode columns
+    # from `COL_KP` up to `COL_ERROR`
+    def state(self):
+        return (self.Kp, self.Ki, self.Kd,
+                self.proportional, self.integral, self.derivative,
+                self.last_error)
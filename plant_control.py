@@ -12,11 +12,13 @@
 import time
 import tclab
 import numpy as np
-import pandas as pd
-from simple_pid import PID
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from episodes import SAMPLE_RATE, EPISODE_LENGTH, EPISODE_COLUMNS, STATE_NORMAL, save_and_plot_episode
+import metrics
+from pid import PID
+from episodes import SAMPLE_RATE, EPISODE_COLUMNS, STATE_NORMAL, EpisodeConfig, EpisodeRecorder, save_and_plot_episode
+from plant_trace import RecordingPlant
+from realtime import RealtimeMode
 
 
 IS_HARDWARE = False
@@ -24,23 +26,70 @@ IS_HARDWARE = False
 PID_TUNINGS = (50.0, 0.001, 0.1)
 SET_POINT = 23.0
 
+# the episode configuration of this run, e.g. 60 second episodes for screening
+EPISODE_T = 300         # seconds
+EPISODE_SAMPLE_RATE = 2 # Hz
 
+TRACE_FILE = None # e.g. "plant-trace.csv", to record the plant's inputs and outputs
+REALTIME_MODE = False # manage garbage collection and pin the control loop to a core, see `realtime.py`
+
+# cycle durations are bucketed relative to the expected cycle time
+CYCLE_BUCKETS = [0.9, 0.99, 1.0, 1.01, 1.05, 1.1, 1.25, 1.5, 2.0, 4.0]
+
+# the number of most recent cycle latencies kept, for percentiles
+LATENCY_SAMPLES = 10_000
+LATENCY_PERCENTILES = (50, 99, 99.9)
+
+CYCLE_DURATION = metrics.histogram('plant_cycle_duration_ratio', 'Cycle duration as a fraction of the expected cycle time', CYCLE_BUCKETS)
+CYCLE_JITTER = metrics.gauge('plant_cycle_jitter_seconds', 'Deviation of the last cycle from the expected cycle time')
+CYCLE_OVERRUNS = metrics.counter('plant_cycle_overruns', 'Cycles that took over 1% longer than expected')
+PID_KP = metrics.gauge('plant_pid_kp', 'Current proportional gain')
+PID_KI = metrics.gauge('plant_pid_ki', 'Current integral gain')
+PID_KD = metrics.gauge('plant_pid_kd', 'Current derivative gain')
+
+
+#
+# By default, the plant control drives the TCLab plant in real time. Pass a
+# `plant` that runs on simulated time, such as `ModelPlant` or `ReplayPlant`,
+# with `realtime=False` to run without sleeping. Time then advances one cycle
+# per step. In real time, such a plant advances with the wall-clock time
+# instead. Pass a `trace_file` to record the plant's inputs and outputs.
+#
 class PlantControl:
-    def __init__(self, is_hardware, starting_pid_tunings):
-        TCLab = tclab.setup(connected=is_hardware)
-        self.plant = TCLab()
+    def __init__(self, is_hardware, starting_pid_tunings, sample_rate=SAMPLE_RATE,
+                 plant=None, realtime=True, trace_file=None):
+        # the TCLab, or its model, set up here keeps its own time
+        self.advances_plant = plant is not None and hasattr(plant, 'update')
+        if plant is None:
+            TCLab = tclab.setup(connected=is_hardware)
+            plant = TCLab()
+        if trace_file is not None:
+            plant = RecordingPlant(plant, trace_file)
+        self.plant = plant
+        self.realtime = realtime
+
         self.y_t_prev = self.plant.T1
         self.previous_time = None
+        self.start_time = None
+        self.simulated_time = 0.0
+        self.start_utc = datetime.utcnow()
 
-        self.pid = PID()
+        self.latencies = np.zeros(LATENCY_SAMPLES)
+        self.n_cycles = 0
 
-        self.cycle_time = 1.0 / SAMPLE_RATE
-        self.pid.sample_time = self.cycle_time
-        print(f"sample rate is {SAMPLE_RATE} Hz, cycle time is {self.pid.sample_time} second")
+        self.pid = PID()
+        self.set_sample_rate(sample_rate)
 
         self.set_pid_tunings(starting_pid_tunings, "program starts")
 
 
+    def set_sample_rate(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.cycle_time = 1.0 / sample_rate
+        self.pid.dt = self.cycle_time
+        print(f"sample rate is {sample_rate} Hz, cycle time is {self.pid.dt} second")
+
+
     def set_pid_tunings(self, pid_tunings, reason):
         if pid_tunings == self.pid.tunings:
             print(f"though {reason}, skip setting PID parameters {pid_tunings} as these already apply")
@@ -48,24 +97,61 @@ class PlantControl:
             print(f"setting PID parameters (Kp, Ki, Kd) to {pid_tunings}, because {reason}")
             self.pid.tunings = pid_tunings
             self.pid.reset()
+            PID_KP.set(pid_tunings[0])
+            PID_KI.set(pid_tunings[1])
+            PID_KD.set(pid_tunings[2])
+
+
+    # the current time, which is simulated time when not running in real time
+    def now(self):
+        if self.realtime:
+            return datetime.utcnow()
+        return self.start_utc + timedelta(seconds=self.simulated_time)
 
 
     def sleep_until_cycle_starts(self):
+        if not self.realtime:
+            self.simulated_time += self.cycle_time
+            self.plant.update(self.simulated_time)
+            return
+
         if self.previous_time is None:
-            self.previous_time = time.time()
+            self.previous_time = self.start_time = time.time()
 
         current_time = time.time()
         while current_time - self.previous_time < self.cycle_time:
             time.sleep(0.001)
             current_time = time.time()
-
-        if current_time - self.previous_time > self.cycle_time * 1.01:
-            print(f"cycle time {current_time - self.previous_time:0.3f} exceeds expected time {self.cycle_time:0.3f}")
+        if self.advances_plant:
+            self.plant.update(current_time - self.start_time)
+
+        cycle_duration = current_time - self.previous_time
+        self.latencies[self.n_cycles % LATENCY_SAMPLES] = cycle_duration - self.cycle_time
+        self.n_cycles += 1
+        CYCLE_DURATION.observe(cycle_duration / self.cycle_time)
+        CYCLE_JITTER.set(cycle_duration - self.cycle_time)
+        if cycle_duration > self.cycle_time * 1.01:
+            CYCLE_OVERRUNS.inc()
+            print(f"cycle time {cycle_duration:0.3f} exceeds expected time {self.cycle_time:0.3f}")
         self.previous_time = current_time
 
 
-    # note that `step()` blocks until the next cycle, to ensure the timings are good
-    def step(self, t, r_t, R_bmk=0.0, u2_t=0.0, episode_state=STATE_NORMAL):
+    # how late the recent cycles started, in seconds, at the given percentiles
+    def cycle_latency(self, percentiles=LATENCY_PERCENTILES):
+        if self.n_cycles == 0:
+            return np.full(len(percentiles), np.nan)
+        return np.percentile(self.latencies[:min(self.n_cycles, LATENCY_SAMPLES)], percentiles)
+
+
+    def report_cycle_latency(self, percentiles=LATENCY_PERCENTILES):
+        latencies = ", ".join(f"p{p:g} {latency * 1000:.2f} ms" for p, latency in zip(percentiles, self.cycle_latency(percentiles)))
+        print(f"cycle latency over the last {min(self.n_cycles, LATENCY_SAMPLES)} cycles: {latencies}")
+
+
+    # note that `step()` blocks until the next cycle, to ensure the timings are
+    # good. The step's values go into `row`, typically the next row of an
+    # `EpisodeRecorder`.
+    def step(self, t, r_t, R_bmk=0.0, u2_t=0.0, episode_state=STATE_NORMAL, row=None):
         self.sleep_until_cycle_starts()
 
         self.pid.setpoint = r_t
@@ -83,12 +169,11 @@ class PlantControl:
         y2_t = self.plant.T2
 
         self.y_t_prev = y_t
-        return [t, r_t,
-                self.pid.Kp, self.pid.Ki, self.pid.Kd,
-                self.pid._proportional, self.pid._integral, self.pid._derivative,
-                self.pid._last_error, R_bmk,
-                u_t_uncapped, u_t, y_t, u2_t, y2_t,
-                episode_state]
+
+        if row is None:
+            row = np.empty(len(EPISODE_COLUMNS))
+        row[:] = (t, r_t) + self.pid.state() + (R_bmk, u_t_uncapped, u_t, y_t, u2_t, y2_t, episode_state)
+        return row
 
 #
 # The remainder of this file is code to try out the plant control. We will reuse
@@ -99,28 +184,39 @@ class PlantControl:
 #
 # Run a single episode of time T.
 #
-def run_episode(plant_control, setpoints):
-    results = pd.DataFrame(columns=EPISODE_COLUMNS)
+def run_episode(plant_control, config, setpoints, realtime_mode=None):
+    if realtime_mode is not None:
+        realtime_mode.start_episode()
+
+    recorder = EpisodeRecorder(config)
     for t in range(len(setpoints)):
-        step_data = plant_control.step(t / SAMPLE_RATE, setpoints[t])
-        results.loc[len(results)] = step_data
+        plant_control.step(t / config.sample_rate, setpoints[t], row=recorder.next_row())
 
-    return results
+    if realtime_mode is not None:
+        realtime_mode.end_episode()
+        plant_control.report_cycle_latency()
+    return recorder.to_frame()
 
 #
 # The main driver, create a plant-control pair, set the set-points and PID
 # tunings and run episodes until the program is stopped.
 #
 if __name__ == "__main__":
-    setpoints = np.zeros(EPISODE_LENGTH)
+    config = EpisodeConfig(EPISODE_T, EPISODE_SAMPLE_RATE)
+    setpoints = np.zeros(config.episode_length)
     setpoints[:] = SET_POINT
 
-    plant_control = PlantControl(IS_HARDWARE, PID_TUNINGS)
+    plant_control = PlantControl(IS_HARDWARE, PID_TUNINGS, config.sample_rate, trace_file=TRACE_FILE)
+
+    realtime_mode = None
+    if REALTIME_MODE:
+        realtime_mode = RealtimeMode()
+        realtime_mode.start()
 
     while True:
         timestamp_utc = datetime.utcnow()
         print(f"generating episode {timestamp_utc.isoformat()}...")
 
-        episode = run_episode(plant_control, setpoints)
+        episode = run_episode(plant_control, config, setpoints, realtime_mode)
         save_and_plot_episode(timestamp_utc, episode)
 
@@ -0,0 +1,108 @@
+#
+# A fast, vectorised model of the TCLab plant under PID control. Where the plant
+# control runs in wall-clock time, this model runs whole episodes for a batch of
+# PID tunings at once, without sleeping. It is not a replacement for the plant,
+# but it is good enough to tell wildly unstable tunings from plausible ones.
+# The same model also drives `ModelPlant`, a stand-in for the TCLab plant for
+# fast, deterministic runs of the control loops.
+#
+# The heater and sensor dynamics are those of TCLab's own simulator,
+# `tclab.TCLabModel`, minus the measurement noise and quantisation. The PID
+# mirrors the one in `pid.py`: derivative on measurement, no output limits and
+# the control variable capped to 0..100% outside the PID.
+#
+
+import numpy as np
+
+
+TA = 21.0       # ambient temperature
+P1 = 200.0      # max power heater 1
+P2 = 100.0      # max power heater 2
+MAX_STEP = 0.2  # maximum time step for integration
+
+
+#
+# Advance the heater temperatures $H$ and sensor temperatures $T$ by `h`
+# seconds, with the heaters at `u1` and `u2` percent. This works on plain
+# floats as well as on arrays of plant states.
+#
+def euler_step(H1, H2, T1, T2, u1, u2, h):
+    dH1 = P1 * u1 / 5720 + (TA - H1) / 20 - (H1 - H2) / 100
+    dH2 = P2 * u2 / 5720 + (TA - H2) / 20 + (H1 - H2) / 100
+    return H1 + h * dH1, H2 + h * dH2, T1 + h * (H1 - T1) / 140, T2 + h * (H2 - T2) / 140
+
+
+#
+# Run an episode for each of the given PID tunings, all starting from the same
+# plant temperatures. Returns the error $e(t)$ for each tuning and each step as
+# a (tunings x steps) array, matching `COL_ERROR` in the episode data frames.
+#
+def simulate_episodes(pid_tunings, config, setpoint, y0=TA, y2_0=TA, u2_t=0.0):
+    pid_tunings = np.asarray(pid_tunings, dtype=float).reshape(-1, 3)
+    Kp, Ki, Kd = pid_tunings[:, 0], pid_tunings[:, 1], pid_tunings[:, 2]
+
+    n_tunings = len(pid_tunings)
+    n_steps = config.episode_length + 1
+    dt = 1.0 / config.sample_rate
+    n_substeps = int(np.ceil(dt / MAX_STEP))
+    h = dt / n_substeps
+
+    H1 = np.full(n_tunings, y0)
+    T1 = np.full(n_tunings, y0)
+    H2 = np.full(n_tunings, y2_0)
+    T2 = np.full(n_tunings, y2_0)
+
+    y_t_prev = T1.copy()
+    last_input = y_t_prev
+    integral = np.zeros(n_tunings)
+    errors = np.empty((n_tunings, n_steps))
+
+    for t in range(n_steps):
+        # the PID sees the value measured in the previous cycle
+        error = setpoint - y_t_prev
+        integral += Ki * error * dt
+        u_t = Kp * error + integral - Kd * (y_t_prev - last_input) / dt
+        u_t = np.clip(u_t, 0.0, 100.0)
+
+        errors[:, t] = error
+        last_input = y_t_prev
+        y_t_prev = T1.copy()
+
+        for _ in range(n_substeps):
+            H1, H2, T1, T2 = euler_step(H1, H2, T1, T2, u_t, u2_t, h)
+
+    return errors
+
+
+#
+# Replay the supervisor's rule on simulated errors. Returns the running error
+# $RR(T)$ and the step at which the supervisor would have fallen back, which is
+# the episode length for tunings that stay under the benchmark.
+#
+def predict_fallback(errors, R_bmk):
+    running_error = np.cumsum(errors**2, axis=1)
+    exceeded = running_error > R_bmk
+    fallback_step = np.where(exceeded.any(axis=1), exceeded.argmax(axis=1), errors.shape[1])
+    return running_error[:, -1], fallback_step
+
+
+#
+# A drop-in replacement for the TCLab plant that runs on simulated time. Like
+# TCLab's own, unsynced simulator, the plant only moves forward when it is told
+# to `update()` to a given time. It needs no sleeping and, without measurement
+# noise, gives the same results on every run.
+#
+class ModelPlant:
+    def __init__(self, y0=TA, y2_0=TA):
+        self.H1, self.H2 = y0, y2_0
+        self.T1, self.T2 = y0, y2_0
+        self.U1, self.U2 = 0.0, 0.0
+        self.t_last = 0.0
+
+    def update(self, t):
+        n_substeps = int(np.ceil((t - self.t_last) / MAX_STEP))
+        if n_substeps > 0:
+            h = (t - self.t_last) / n_substeps
+            for _ in range(n_substeps):
+                self.H1, self.H2, self.T1, self.T2 = euler_step(self.H1, self.H2, self.T1, self.T2, self.U1, self.U2, h)
+        self.t_last = t
@@ -0,0 +1,136 @@
+#
+# Record and replay the plant's inputs and outputs. A recording plant wraps the
+# TCLab plant and logs every heater setting and every temperature reading. A
+# replay plant feeds the recorded readings back to the control loop, through
+# the same interface, without sleeping. Together with `ModelPlant`, this lets
+# us re-run supervised and auto-tuning sessions deterministically and at CPU
+# speed, to compare versions of the code for behaviour and performance.
+#
+# Traces are CSV files with one event per line: the channel (`U1`, `U2`, `T1`
+# or `T2`) and its value, in the order in which they happened.
+#
+
+import os
+import atexit
+import pandas as pd
+
+
+CHANNELS = ['U1', 'U2', 'T1', 'T2']
+FLUSH_EVENTS = 2400 # about one nominal episode at four events per step
+
+
+class RecordingPlant:
+    def __init__(self, plant, trace_file):
+        self.plant = plant
+        self.trace_file = trace_file
+        self.events = []
+
+        if os.path.exists(trace_file):
+            os.remove(trace_file)
+        atexit.register(self.flush)
+
+    def record(self, channel, value):
+        self.events.append((channel, value))
+        if len(self.events) >= FLUSH_EVENTS:
+            self.flush()
+
+    # plants on simulated time are moved forward by the plant control
+    def update(self, t):
+        self.plant.update(t)
+
+    def flush(self):
+        if len(self.events) == 0:
+            return
+
+        write_header = not os.path.exists(self.trace_file)
+        pd.DataFrame(self.events, columns=['channel', 'value']).to_csv(self.trace_file, mode='a', header=write_header, index=False)
+        self.events = []
+
+    @property
+    def T1(self):
+        y_t = self.plant.T1
+        self.record('T1', y_t)
+        return y_t
+
+    @property
+    def T2(self):
+        y2_t = self.plant.T2
+        self.record('T2', y2_t)
+        return y2_t
+
+    @property
+    def U1(self):
+        return self.plant.U1
+
+    @U1.setter
+    def U1(self, u_t):
+        self.record('U1', u_t)
+        self.plant.U1 = u_t
+
+    @property
+    def U2(self):
+        return self.plant.U2
+
+    @U2.setter
+    def U2(self, u2_t):
+        self.record('U2', u2_t)
+        self.plant.U2 = u2_t
+
+
+#
+# Replays the temperatures from a trace, regardless of how the control loop
+# drives the heaters. As long as the code under test drives the heaters as it
+# did when recording, the replay is faithful. We count the heater settings that
+# diverge from the recording, so that a regression run can tell whether its
+# replay still means anything.
+#
+class ReplayPlant:
+    def __init__(self, trace_file, tolerance=1e-9):
+        trace = pd.read_csv(trace_file, float_precision='round_trip')
+        self.values = {channel: trace.loc[trace['channel'] == channel, 'value'].to_numpy()
+                       for channel in CHANNELS}
+        self.positions = {channel: 0 for channel in CHANNELS}
+        self.tolerance = tolerance
+
+        self.n_diverged = 0
+        self.U1_, self.U2_ = 0.0, 0.0
+
+    def next_value(self, channel):
+        position = self.positions[channel]
+        if position >= len(self.values[channel]):
+            raise EOFError(f"end of plant trace, no more {channel} events")
+        self.positions[channel] = position + 1
+        return self.values[channel][position]
+
+    def update(self, t):
+        pass # the recording already moved forward
+
+    def check(self, channel, value):
+        if abs(self.next_value(channel) - value) > self.tolerance:
+            self.n_diverged += 1
+
+    @property
+    def T1(self):
+        return self.next_value('T1')
+
+    @property
+    def T2(self):
+        return self.next_value('T2')
+
+    @property
+    def U1(self):
+        return self.U1_
+
+    @U1.setter
+    def U1(self, u_t):
+        self.check('U1', u_t)
+        self.U1_ = u_t
+
+    @property
+    def U2(self):
+        return self.U2_
+
+    @U2.setter
+    def U2(self, u2_t):
+        self.check('U2', u2_t)
+        self.U2_ = u2_t
@@ -3,14 +3,23 @@
 # A script to ingest a bunch of episodes and plot how the PID parameters
 # progressed over time. This gives some idea on how learning progresses.
 #
+# With more than `AGGREGATE_EPISODES` episodes, or with `--aggregate`, the plots
+# are aggregated: the scatter plots become density images, binned with
+# `np.histogram2d`, and the time series are reduced to the minimum and maximum
+# of each of `MAX_POINTS / 2` buckets. That keeps the render time and the
+# readability of the plots roughly constant as the archive grows.
+#
+#     (venv) $ python plot_learning.py [--aggregate] episodes/*.parquet
+#
 import re
 import sys
 import numpy as np
 import pandas as pd
 from datetime import datetime
 import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
 
-from episodes import COL_TIME, COL_KP, COL_KI, COL_KD, COL_BENCHMARK, COL_ERROR, COL_STATE, STATE_NORMAL, STATE_FALLBACK
+from episodes import COL_TIME, COL_KP, COL_KI, COL_KD, COL_BENCHMARK, COL_ERROR, COL_STATE, STATE_NORMAL, STATE_FALLBACK, load_episode
 
 
 COL_KP_END = 'applied proportional gain $K_p$'
@@ -24,12 +33,101 @@ LEARNING_COLUMNS = [
     COL_BENCHMARK, COL_ERROR,           # the sum of the squared error
     COL_STATE                           # the final state of the episode
 ]
-learning = pd.DataFrame(columns=LEARNING_COLUMNS)
 
-files = sys.argv[1:]
+AGGREGATE_EPISODES = 5000
+MAX_POINTS = 2000     # per time series, when aggregated
+DENSITY_BINS = 100    # per axis, for the density images
+DENSITY_BINS_3D = 20  # per axis, for the 3D plot
+
+
+#
+# Reduce a time series to the minimum and the maximum of each bucket, in time
+# order. Unlike taking every n-th point, this keeps the spikes.
+#
+def min_max_decimate(t, y, max_points=MAX_POINTS):
+    t = np.asarray(t)
+    y = np.asarray(y, dtype=float)
+    if len(y) <= max_points:
+        return t, y
+
+    size = -(-len(y) // (max_points // 2))
+    n_buckets = -(-len(y) // size)
+    buckets = np.pad(y, (0, size * n_buckets - len(y)), mode='edge').reshape(n_buckets, size)
+
+    picks = np.sort(np.stack((buckets.argmin(axis=1), buckets.argmax(axis=1)), axis=1), axis=1)
+    picks = np.minimum((picks + np.arange(n_buckets)[:, None] * size).ravel(), len(y) - 1)
+    return t[picks], y[picks]
+
+
+def plot_time_series(ax, t, y, aggregate, **kwargs):
+    if aggregate:
+        t, y = min_max_decimate(t, y)
+    ax.plot(t, y, **kwargs)
+
+
+def extent_of(*values):
+    values = np.concatenate([np.asarray(v, dtype=float) for v in values])
+    low, high = (values.min(), values.max()) if len(values) > 0 else (0.0, 1.0)
+    return (low, high) if high > low else (low - 0.5, high + 0.5)
+
+
+def plot_density(ax, x, y, cmap, extent):
+    if len(x) == 0:
+        return
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=DENSITY_BINS, range=extent)
+    # a floor below one, so that even single tunings show up
+    norm = LogNorm(vmin=0.1, vmax=max(counts.max(), 1.0))
+    ax.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts.T, 0), cmap=cmap, norm=norm, alpha=0.8)
+
+
+#
+# Scatter the proposed tunings, that fell back, in red and the applied ones in
+# blue. Aggregated, plot their densities within the given extent, or within the
+# extent of the data if none is given.
+#
+def plot_gains(ax, proposed_x, proposed_y, applied_x, applied_y, aggregate, extent=None):
+    if not aggregate:
+        ax.scatter(proposed_x, proposed_y, color='r', alpha=0.2)
+        ax.scatter(applied_x, applied_y,   color='b')
+        return
+
+    if extent is None:
+        extent = (extent_of(proposed_x, applied_x), extent_of(proposed_y, applied_y))
+    plot_density(ax, proposed_x, proposed_y, 'Reds', extent)
+    plot_density(ax, applied_x, applied_y,   'Blues', extent)
+
+
+# a linear fit, drawn between the extremes of x
+def plot_trend(ax, x, y):
+    if len(x) > 1:
+        x_ends = np.array([x.min(), x.max()])
+        ax.plot(x_ends, np.poly1d(np.polyfit(x, y, 1))(x_ends), color='g')
+
+
+#
+# Aggregated, the 3D scatter shows one point per occupied cell of a coarse 3D
+# histogram, sized by the number of tunings in it.
+#
+def plot_gains_3d(ax, gains, aggregate, **kwargs):
+    gains = np.asarray(gains, dtype=float)
+    if not aggregate or len(gains) == 0:
+        ax.scatter(gains[:, 0], gains[:, 1], gains[:, 2], **kwargs)
+        return
+
+    counts, edges = np.histogramdd(gains, bins=DENSITY_BINS_3D)
+    occupied = np.nonzero(counts)
+    centers = [(e[:-1] + e[1:])[i] / 2 for e, i in zip(edges, occupied)]
+    ax.scatter(*centers, s=2 + 50 * counts[occupied] / counts.max(), **kwargs)
+
+
+aggregate = '--aggregate' in sys.argv
+files = [arg for arg in sys.argv[1:] if arg != '--aggregate']
 files.sort()
+aggregate = aggregate or len(files) > AGGREGATE_EPISODES
+
+rows = []
 for file in files:
-    episode = pd.read_parquet(file)
+    episode = load_episode(file)
 
     t_string = re.sub('.*/', '', file)
     t_string = re.sub('\..*', '', t_string)
@@ -44,28 +142,29 @@ for file in files:
                        last_step[COL_KP], last_step[COL_KI], last_step[COL_KD],
                        first_step[COL_BENCHMARK], cumulative_error,
                        last_step[COL_STATE]]
-    learning.loc[len(learning)] = episode_summary
+    rows.append(episode_summary)
+learning = pd.DataFrame(rows, columns=LEARNING_COLUMNS)
 
 plt.rcParams['lines.linewidth'] = 0.8
 fig, axes = plt.subplot_mosaic("EEE;PPP;III;DDD;xyz;klm;uvw", figsize=(15,15))
 
-axes['E'].plot(learning[COL_TIME], learning[COL_ERROR],     color='orange',    label='episode error $RR_T$')
-axes['E'].plot(learning[COL_TIME], learning[COL_BENCHMARK], color='lightgrey', label=COL_BENCHMARK)
-axes['E'].set_ylim((0, first_step[COL_BENCHMARK] * 4))
+plot_time_series(axes['E'], learning[COL_TIME], learning[COL_ERROR], aggregate,     color='orange',    label='episode error $RR_T$')
+plot_time_series(axes['E'], learning[COL_TIME], learning[COL_BENCHMARK], aggregate, color='lightgrey', label=COL_BENCHMARK)
+axes['E'].set_ylim((0, learning[COL_BENCHMARK].iloc[-1] * 4))
 axes['E'].legend(loc='upper left')
 
 # ---
 
-axes['P'].plot(learning[COL_TIME], learning[COL_KP],     color='r', linestyle=':', label='proposed ' + COL_KP)
-axes['P'].plot(learning[COL_TIME], learning[COL_KP_END], color='b', label=COL_KP_END)
+plot_time_series(axes['P'], learning[COL_TIME], learning[COL_KP], aggregate,     color='r', linestyle=':', label='proposed ' + COL_KP)
+plot_time_series(axes['P'], learning[COL_TIME], learning[COL_KP_END], aggregate, color='b', label=COL_KP_END)
 axes['P'].legend(loc='upper left')
 
-axes['I'].plot(learning[COL_TIME], learning[COL_KI],     color='r', linestyle=':', label='proposed ' +COL_KI)
-axes['I'].plot(learning[COL_TIME], learning[COL_KI_END], color='b', label=COL_KI_END)
+plot_time_series(axes['I'], learning[COL_TIME], learning[COL_KI], aggregate,     color='r', linestyle=':', label='proposed ' +COL_KI)
+plot_time_series(axes['I'], learning[COL_TIME], learning[COL_KI_END], aggregate, color='b', label=COL_KI_END)
 axes['I'].legend(loc='upper left')
 
-axes['D'].plot(learning[COL_TIME], learning[COL_KD],     color='r', linestyle=':', label='proposed ' +COL_KD)
-axes['D'].plot(learning[COL_TIME], learning[COL_KD_END], color='b',                label=COL_KD_END)
+plot_time_series(axes['D'], learning[COL_TIME], learning[COL_KD], aggregate,     color='r', linestyle=':', label='proposed ' +COL_KD)
+plot_time_series(axes['D'], learning[COL_TIME], learning[COL_KD_END], aggregate, color='b',                label=COL_KD_END)
 axes['D'].legend(loc='upper left')
 
 # ---
@@ -73,18 +172,18 @@ axes['D'].legend(loc='upper left')
 only_proposed = learning.loc[learning[COL_STATE] == STATE_FALLBACK]
 only_applied  = learning.loc[learning[COL_STATE] == STATE_NORMAL]
 
-axes['x'].scatter(only_proposed[COL_KP], only_proposed[COL_KI],       color='r', alpha=0.2)
-axes['x'].scatter(only_applied[COL_KP_END], only_applied[COL_KI_END], color='b')
+plot_gains(axes['x'], only_proposed[COL_KP], only_proposed[COL_KI],
+           only_applied[COL_KP_END], only_applied[COL_KI_END], aggregate)
 axes['x'].set_xlabel(COL_KP)
 axes['x'].set_ylabel(COL_KI)
 
-axes['y'].scatter(only_proposed[COL_KI], only_proposed[COL_KD],       color='r', alpha=0.2)
-axes['y'].scatter(only_applied[COL_KI_END], only_applied[COL_KD_END], color='b')
+plot_gains(axes['y'], only_proposed[COL_KI], only_proposed[COL_KD],
+           only_applied[COL_KI_END], only_applied[COL_KD_END], aggregate)
 axes['y'].set_xlabel(COL_KI)
 axes['y'].set_ylabel(COL_KD)
 
-axes['z'].scatter(only_proposed[COL_KD], only_proposed[COL_KP],       color='r', alpha=0.2)
-axes['z'].scatter(only_applied[COL_KD_END], only_applied[COL_KP_END], color='b')
+plot_gains(axes['z'], only_proposed[COL_KD], only_proposed[COL_KP],
+           only_applied[COL_KD_END], only_applied[COL_KP_END], aggregate)
 axes['z'].set_xlabel(COL_KD)
 axes['z'].set_ylabel(COL_KP)
 
@@ -99,34 +198,31 @@ max_d = only_applied[COL_KD_END].max() * 1.1
 min_e = only_applied[COL_ERROR].min()  * 0.9
 max_e = only_applied[COL_ERROR].max()  * 1.1
 
-axes['k'].scatter(only_proposed[COL_KP_END], only_proposed[COL_KI_END], color='r', alpha=0.2)
-axes['k'].scatter(only_applied[COL_KP_END], only_applied[COL_KI_END],   color='b')
-if len(only_applied) > 1:
-    axes['k'].plot(np.unique(only_applied[COL_KP_END]), np.poly1d(np.polyfit(only_applied[COL_KP_END], only_applied[COL_KI_END], 1))(np.unique(only_applied[COL_KP_END])), color='g')
+plot_gains(axes['k'], only_proposed[COL_KP_END], only_proposed[COL_KI_END],
+           only_applied[COL_KP_END], only_applied[COL_KI_END], aggregate, ((min_p, max_p), (min_i, max_i)))
+plot_trend(axes['k'], only_applied[COL_KP_END], only_applied[COL_KI_END])
 axes['k'].set_xlim((min_p, max_p))
 axes['k'].set_ylim((min_i, max_i))
 axes['k'].set_ylabel(COL_KI)
 
-axes['l'].scatter(only_proposed[COL_KI_END], only_proposed[COL_KD_END], color='r', alpha=0.2)
-axes['l'].scatter(only_applied[COL_KI_END], only_applied[COL_KD_END],   color='b')
-if len(only_applied) > 1:
-    axes['l'].plot(np.unique(only_applied[COL_KI_END]), np.poly1d(np.polyfit(only_applied[COL_KI_END], only_applied[COL_KD_END], 1))(np.unique(only_applied[COL_KI_END])), color='g')
+plot_gains(axes['l'], only_proposed[COL_KI_END], only_proposed[COL_KD_END],
+           only_applied[COL_KI_END], only_applied[COL_KD_END], aggregate, ((min_i, max_i), (min_d, max_d)))
+plot_trend(axes['l'], only_applied[COL_KI_END], only_applied[COL_KD_END])
 axes['l'].set_xlim((min_i, max_i))
 axes['l'].set_ylim((min_d, max_d))
 axes['l'].set_ylabel(COL_KD)
 
-axes['m'].scatter(only_proposed[COL_KD_END], only_proposed[COL_KP_END], color='r', alpha=0.2)
-axes['m'].scatter(only_applied[COL_KD_END], only_applied[COL_KP_END],   color='b')
-if len(only_applied) > 1:
-    axes['m'].plot(np.unique(only_applied[COL_KD_END]), np.poly1d(np.polyfit(only_applied[COL_KD_END], only_applied[COL_KP_END], 1))(np.unique(only_applied[COL_KD_END])), color='g')
+plot_gains(axes['m'], only_proposed[COL_KD_END], only_proposed[COL_KP_END],
+           only_applied[COL_KD_END], only_applied[COL_KP_END], aggregate, ((min_d, max_d), (min_p, max_p)))
+plot_trend(axes['m'], only_applied[COL_KD_END], only_applied[COL_KP_END])
 axes['m'].set_xlim((min_d, max_d))
 axes['m'].set_ylim((min_p, max_p))
 axes['m'].set_ylabel(COL_KP)
 
 # ---
 
-axes['u'].scatter(only_proposed[COL_KP_END], only_proposed[COL_ERROR], color='r', alpha=0.2)
-axes['u'].scatter(only_applied[COL_KP_END], only_applied[COL_ERROR],   color='b')
+plot_gains(axes['u'], only_proposed[COL_KP_END], only_proposed[COL_ERROR],
+           only_applied[COL_KP_END], only_applied[COL_ERROR], aggregate, ((min_p, max_p), (min_e, max_e)))
 min_err_kp = only_applied[COL_KP_END][only_applied[COL_ERROR].idxmin()]
 axes['u'].axvline(min_err_kp, color='g', label=f"$K_p$: {min_err_kp}")
 axes['u'].set_xlim((min_p, max_p))
@@ -135,8 +231,8 @@ axes['u'].set_ylim((min_e, max_e))
 axes['u'].set_ylabel(COL_ERROR)
 axes['u'].legend(loc='upper left')
 
-axes['v'].scatter(only_proposed[COL_KI_END], only_proposed[COL_ERROR], color='r', alpha=0.2)
-axes['v'].scatter(only_applied[COL_KI_END], only_applied[COL_ERROR],   color='b')
+plot_gains(axes['v'], only_proposed[COL_KI_END], only_proposed[COL_ERROR],
+           only_applied[COL_KI_END], only_applied[COL_ERROR], aggregate, ((min_i, max_i), (min_e, max_e)))
 min_err_ki = only_applied[COL_KI_END][only_applied[COL_ERROR].idxmin()]
 axes['v'].axvline(min_err_ki, color='g', label=f"$K_i$: {min_err_ki}")
 axes['v'].set_xlim((min_i, max_i))
@@ -144,8 +240,8 @@ axes['v'].set_ylim((min_e, max_e))
 axes['v'].set_xlabel(COL_KI)
 axes['v'].legend(loc='upper left')
 
-axes['w'].scatter(only_proposed[COL_KD_END], only_proposed[COL_ERROR], color='r', alpha=0.2)
-axes['w'].scatter(only_applied[COL_KD_END], only_applied[COL_ERROR],   color='b')
+plot_gains(axes['w'], only_proposed[COL_KD_END], only_proposed[COL_ERROR],
+           only_applied[COL_KD_END], only_applied[COL_ERROR], aggregate, ((min_d, max_d), (min_e, max_e)))
 min_err_kd = only_applied[COL_KD_END][only_applied[COL_ERROR].idxmin()]
 axes['w'].axvline(min_err_kd, color='g', label=f"$K_d$: {min_err_kd}")
 axes['w'].set_xlim((min_d, max_d))
@@ -160,8 +256,8 @@ plt.close(fig)
 
 fig = plt.figure()
 ax = fig.add_subplot(projection='3d')
-ax.scatter(only_proposed[COL_KP], only_proposed[COL_KI], only_proposed[COL_KD],          color='r', alpha=0.2, label='proposed')
-ax.scatter(only_applied[COL_KP_END], only_applied[COL_KI_END], only_applied[COL_KD_END], color='b',            label='applied')
+plot_gains_3d(ax, only_proposed[[COL_KP, COL_KI, COL_KD]],             aggregate, color='r', alpha=0.2, label='proposed')
+plot_gains_3d(ax, only_applied[[COL_KP_END, COL_KI_END, COL_KD_END]], aggregate, color='b',            label='applied')
 
 ax.set_xlabel(COL_KP)
 ax.set_ylabel(COL_KI)
@@ -0,0 +1,80 @@
+#
+# An opt-in real-time mode for the control loops. Besides the loop's own work,
+# two things make cycles overrun: garbage collections that happen to kick in
+# mid-cycle, and other threads, such as torch's, that compete for the core the
+# control loop runs on. In real-time mode we:
+#
+# - freeze the objects allocated during start-up with `gc.freeze()`, so that
+#   collections no longer scan them over and over
+# - disable the garbage collector during an episode, and collect at its end,
+#   in the slack before the next episode starts
+# - pin the control thread to a core of its own, and move all other threads of
+#   the process off that core
+#
+# Pinning uses `os.sched_setaffinity()`, which is only available on Linux, and
+# needs at least two cores. Otherwise, only the garbage collector is managed.
+#
+
+import gc
+import os
+import time
+import threading
+
+
+CONTROL_CORE = None # the core to run the control loop on, the last available one if None
+
+
+class RealtimeMode:
+    def __init__(self, control_core=CONTROL_CORE):
+        self.control_core = control_core
+        self.control_thread = None
+        self.other_cores = None
+
+
+    # call once start-up is done, from the control thread
+    def start(self):
+        gc.collect()
+        gc.freeze()
+        print(f"real-time mode: froze {gc.get_freeze_count()} objects allocated during start-up")
+
+        if not hasattr(os, 'sched_setaffinity'):
+            print("real-time mode: CPU affinity is not supported here, not pinning the control thread")
+            return
+        cores = os.sched_getaffinity(0)
+        if len(cores) < 2:
+            print(f"real-time mode: only {len(cores)} core available, not pinning the control thread")
+            return
+
+        if self.control_core is None:
+            self.control_core = max(cores)
+        self.other_cores = cores - {self.control_core}
+        self.control_thread = threading.get_native_id()
+
+        os.sched_setaffinity(0, {self.control_core})
+        self.keep_other_threads_off()
+        print(f"real-time mode: pinned the control thread to core {self.control_core}, other threads to cores {sorted(self.other_cores)}")
+
+
+    # threads started by the control thread, such as torch's worker threads,
+    # inherit its core. So we move all other threads off it again each episode.
+    def keep_other_threads_off(self):
+        for task in os.listdir('/proc/self/task'):
+            thread = int(task)
+            if thread != self.control_thread:
+                try:
+                    os.sched_setaffinity(thread, self.other_cores)
+                except OSError:
+                    pass # the thread has ended in the meantime
+
+
+    def start_episode(self):
+        if self.control_thread is not None:
+            self.keep_other_threads_off()
+        gc.disable()
+
+
+    def end_episode(self):
+        start_time = time.perf_counter()
+        n_collected = gc.collect()
+        gc.enable()
+        print(f"real-time mode: collected {n_collected} objects in {(time.perf_counter() - start_time) * 1000:.1f} ms after the episode")
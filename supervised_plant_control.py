@@ -6,11 +6,13 @@
 # loop to known-stable (though suboptimal) PID parameters.
 #
 
-import pandas as pd
 from datetime import datetime
 
-from episodes import SAMPLE_RATE, EPISODE_LENGTH, COL_ERROR, EPISODE_COLUMNS, STATE_NORMAL, STATE_FALLBACK, save_and_plot_episode
+import metrics
+from episodes import COL_ERROR, EPISODE_COLUMNS, STATE_NORMAL, STATE_FALLBACK, EpisodeConfig, EpisodeRecorder, save_and_plot_episode
 from plant_control import PlantControl
+from realtime import RealtimeMode
+from telemetry import TelemetryRing
 
 
 IS_HARDWARE = False
@@ -21,11 +23,50 @@ SET_POINT = 23.0
 BENCHMARK_ERROR = 9.0
 FALLBACK_PID_TUNINGS = (20.0, 0.1, 0.01)
 
+# the episode configuration of this run, e.g. 60 second episodes for screening
+EPISODE_T = 300         # seconds
+EPISODE_SAMPLE_RATE = 2 # Hz
+
+#
+# Once the supervisor fell back, the remainder of the episode teaches us little.
+# When early termination is enabled, the episode ends as soon as the plant has
+# settled under the fall-back tunings. The plant counts as settled when the
+# mean squared error over the last `SETTLE_TIME` seconds is below
+# `SETTLE_ERROR`. Being a mean, it means the same at any sample rate. TCLab
+# quantises its readings to `TCLAB_RESOLUTION`, so a settled plant still shows
+# some error. Keep `SETTLE_ERROR` above one quantisation step squared, about
+# 0.104, or a settled TCLab may never count as settled.
+#
+END_ON_SETTLE = False
+SETTLE_TIME = 30    # seconds
+SETTLE_ERROR = 0.15 # mean squared error per sample over `SETTLE_TIME`, in (°C)²
+TCLAB_RESOLUTION = 0.3223 # °C
+
+METRICS_PORT = None # e.g. 9100, to serve metrics on http://127.0.0.1:9100/metrics
+REALTIME_MODE = False # manage garbage collection and pin the control loop to a core, see `realtime.py`
+TELEMETRY_NAME = None # e.g. "pid-telemetry", to publish each step to shared memory, see `telemetry.py`
+
+I_ERROR = EPISODE_COLUMNS.index(COL_ERROR)
+
+FALLBACKS = metrics.counter('supervisor_fallbacks', 'Transitions into the fall-back state')
+FALLBACKS_PER_HOUR = metrics.gauge('supervisor_fallbacks_per_hour', 'Average fall-back transitions per hour',
+                                   lambda: FALLBACKS.value / metrics.hours_running())
+RUNNING_ERROR = metrics.gauge('supervisor_running_error', 'Running error RR(t) of the current episode')
+BENCHMARK_ERROR_GAUGE = metrics.gauge('supervisor_benchmark_error', 'Benchmark error R_bmk')
+
 class SupervisedPlantControl:
-    def __init__(self, plant, R_bmk, fallback_pid_tunings):
+    def __init__(self, plant, R_bmk, fallback_pid_tunings, config=None,
+                 end_on_settle=END_ON_SETTLE, settle_time=SETTLE_TIME, settle_error=SETTLE_ERROR,
+                 realtime_mode=None, telemetry=None):
         self.plant = plant
+        self.realtime_mode = realtime_mode
+        self.telemetry = telemetry
+
+        self.config = config if config is not None else EpisodeConfig(sample_rate=plant.sample_rate)
+        self.proposed_config = self.config
 
-        self.t = EPISODE_LENGTH # so we start a new episode on the next step
+        self.t = 0
+        self.done = True # so we start a new episode on the next step
 
         self.episode_state = STATE_NORMAL
         self.R_bmk = R_bmk
@@ -33,12 +74,35 @@ class SupervisedPlantControl:
         self.fallback_pid_tunings = fallback_pid_tunings
         self.proposed_pid_tunings = fallback_pid_tunings
 
+        self.end_on_settle = end_on_settle
+        self.settle_time = settle_time
+        self.settle_error = settle_error
+
 
     def start_episode(self):
+        if self.proposed_config is not self.config:
+            self.config = self.proposed_config
+            print(f"episode configuration is now {self.config}")
+        if self.plant.sample_rate != self.config.sample_rate:
+            self.plant.set_sample_rate(self.config.sample_rate)
+        self.settle_steps = int(self.settle_time * self.config.sample_rate)
+
         self.t = 0
-        self.results = pd.DataFrame(columns=EPISODE_COLUMNS)
+        self.done = False
+        self.recorder = EpisodeRecorder(self.config)
+        self.running_error = 0.0
         self.episode_state = STATE_NORMAL
+        self.t_fallback = None
         self.plant.set_pid_tunings(self.proposed_pid_tunings, "episode starts")
+        if self.realtime_mode is not None:
+            self.realtime_mode.start_episode()
+
+
+    def end_episode(self):
+        self.done = True
+        if self.realtime_mode is not None:
+            self.realtime_mode.end_episode()
+            self.plant.report_cycle_latency()
 
 
     # note that these tunings will only be applied at the start of an episode;
@@ -47,24 +111,56 @@ class SupervisedPlantControl:
         self.proposed_pid_tunings = pid_tunings
 
 
+    # like the tunings, a new episode configuration only applies from the start
+    # of the next episode.
+    def set_episode_config(self, config):
+        self.proposed_config = config
+
+
+    # the plant has settled when the mean squared error over the last
+    # `settle_steps` steps is small, all of which must have run under fall-back
+    # tunings.
+    def is_settled(self):
+        if self.t_fallback is None or self.t - self.t_fallback < self.settle_steps:
+            return False
+
+        window_error = (self.recorder.column(COL_ERROR)[-self.settle_steps:]**2).mean()
+        return window_error < self.settle_error
+
+
     def step(self, setpoint):
-        if self.t == EPISODE_LENGTH:
+        if self.done:
             self.start_episode()
         else:
             self.t += 1
 
-        step_data = self.plant.step(self.t / SAMPLE_RATE, setpoint,
-                                    R_bmk=self.R_bmk, episode_state=self.episode_state)
-        self.results.loc[len(self.results)] = step_data
-
-        # in fallback state we just sit the episode out
-        running_error = (self.results[COL_ERROR]**2).sum()
+        step_data = self.plant.step(self.t / self.config.sample_rate, setpoint,
+                                    R_bmk=self.R_bmk, episode_state=self.episode_state,
+                                    row=self.recorder.next_row())
+        if self.telemetry is not None:
+            self.telemetry.publish(step_data)
+
+        # in fallback state we just sit the episode out, or until the plant settled
+        self.running_error += step_data[I_ERROR]**2
+        running_error = self.running_error
+        RUNNING_ERROR.set(running_error)
+        BENCHMARK_ERROR_GAUGE.set(self.R_bmk)
         if self.episode_state != STATE_FALLBACK and running_error > self.R_bmk:
             self.episode_state = STATE_FALLBACK
+            self.t_fallback = self.t
+            FALLBACKS.inc()
             self.plant.set_pid_tunings(self.fallback_pid_tunings,
                                        f"running error {running_error:.1f} exceeds benchmark error {self.R_bmk:.1f}")
 
-        return self.results, self.t == EPISODE_LENGTH
+        if self.t == self.config.episode_length:
+            self.end_episode()
+        elif self.end_on_settle and self.is_settled():
+            print(f"plant settled under fall-back tunings, ending episode early at {self.t / self.config.sample_rate:.1f} seconds")
+            self.end_episode()
+
+        # the recorder, rather than a data frame, keeps the step cheap; call
+        # `to_frame()` on it when the episode is done
+        return self.recorder, self.done
 
 
 #
@@ -72,15 +168,24 @@ class SupervisedPlantControl:
 # and PID tunings and run episodes until the program is stopped.
 #
 if __name__ == "__main__":
-    plant_control = PlantControl(IS_HARDWARE, FALLBACK_PID_TUNINGS)
+    if METRICS_PORT is not None:
+        metrics.serve_metrics(METRICS_PORT)
+
+    config = EpisodeConfig(EPISODE_T, EPISODE_SAMPLE_RATE)
+    plant_control = PlantControl(IS_HARDWARE, FALLBACK_PID_TUNINGS, config.sample_rate)
 
-    supervised_plant_control = SupervisedPlantControl(plant_control, BENCHMARK_ERROR, FALLBACK_PID_TUNINGS)
+    realtime_mode = RealtimeMode() if REALTIME_MODE else None
+    telemetry = TelemetryRing(TELEMETRY_NAME) if TELEMETRY_NAME is not None else None
+    supervised_plant_control = SupervisedPlantControl(plant_control, BENCHMARK_ERROR, FALLBACK_PID_TUNINGS, config,
+                                                      realtime_mode=realtime_mode, telemetry=telemetry)
     supervised_plant_control.set_pid_tunings(PID_TUNINGS)
+    if realtime_mode is not None:
+        realtime_mode.start()
 
     while True:
-        episode, done = supervised_plant_control.step(SET_POINT)
+        recorder, done = supervised_plant_control.step(SET_POINT)
         if done:
             timestamp_utc = datetime.utcnow() # XXX push into episode
             print(f"saving episode {timestamp_utc.isoformat()}...")
-            save_and_plot_episode(timestamp_utc, episode)
+            save_and_plot_episode(timestamp_utc, recorder.to_frame())
 
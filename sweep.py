@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# A script to sweep the auto-tuner's hyperparameters. Each configuration runs
+# as an isolated training job on the simulated plant, in simulated time, in a
+# pool of processes. Each job gets its own seed and a limited number of CPU
+# threads, so that jobs do not compete for cores. The learning curves are
+# summarised into one table, so that configurations can be compared.
+#
+# Finished jobs leave their results in the sweep directory. Running the same
+# sweep again skips those, so a sweep picks up where it left off if it, or one
+# of its jobs, died.
+#
+# The sweep is specified by the constants below, or by a JSON file with the
+# same keys in lower case, given on the command line:
+#
+#     (venv) $ python sweep.py sweep.json
+#
+# A grid search runs every combination of the parameter values. A random search
+# runs `N_RANDOM` configurations, picking each parameter from its list of
+# values, or from a `{"low": ..., "high": ..., "log": true}` range.
+#
+
+import os
+import sys
+import json
+import random
+import hashlib
+import itertools
+import traceback
+import contextlib
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+SWEEP_DIR = "sweep"
+
+SEARCH = 'grid' # or 'random'
+N_RANDOM = 16
+PARAMETERS = {
+    'tau': [0.001, 0.005],
+    'batch_size': [64, 256],
+    'benchmark_error': [10.0, 15.0],
+}
+
+N_EPISODES = 600
+N_SEEDS = 1 # repeats of each configuration, each with its own seed
+BASE_SEED = 42
+
+THREADS_PER_JOB = 1
+N_WORKERS = max(1, (os.cpu_count() or 1) // THREADS_PER_JOB)
+
+SUMMARY_FRACTION = 0.2 # summarise over the last 20% of the episodes
+
+
+def sample(values):
+    if isinstance(values, dict):
+        if values.get('log', False):
+            return float(np.exp(np.random.uniform(np.log(values['low']), np.log(values['high']))))
+        return float(np.random.uniform(values['low'], values['high']))
+    return values[np.random.randint(len(values))]
+
+
+def configurations(search, parameters, n_random):
+    if search == 'grid':
+        names = list(parameters.keys())
+        return [dict(zip(names, values)) for values in itertools.product(*parameters.values())]
+    return [{name: sample(values) for name, values in parameters.items()} for _ in range(n_random)]
+
+
+def job_id(configuration, seed):
+    key = json.dumps({'configuration': configuration, 'seed': seed}, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+#
+# Summarise a learning curve, a list of (error, fell back) tuples, into a few
+# numbers that we can compare across configurations.
+#
+def summarise(learning_curve):
+    errors = np.array([error for error, _ in learning_curve])
+    fell_back = np.array([fell_back for _, fell_back in learning_curve], dtype=bool)
+    tail = slice(-max(1, int(len(learning_curve) * SUMMARY_FRACTION)), None)
+
+    stable_errors = np.where(fell_back, np.inf, errors)
+    best = int(np.argmin(stable_errors)) if (~fell_back).any() else None
+    return {
+        'episodes': len(learning_curve),
+        'fallback_rate': float(fell_back.mean()),
+        'fallback_rate_tail': float(fell_back[tail].mean()),
+        'mean_error_tail': float(errors[tail][~fell_back[tail]].mean()) if (~fell_back[tail]).any() else np.nan,
+        'best_error': float(stable_errors[best]) if best is not None else np.nan,
+        'best_episode': best,
+    }
+
+
+#
+# Runs in a worker process. Limit the threads before doing any work, seed
+# everything, then run the auto-tuner on the plant model with its output going
+# to the job's log file. The result is written atomically, so that a result
+# file always means a finished job.
+#
+def run_job(sweep_dir, job, configuration, seed, n_episodes, threads):
+    import torch
+    import autotuning_supervised_plant_control as autotuner
+    from plant_model import ModelPlant
+
+    torch.set_num_threads(threads)
+    autotuner.LEARN_THREADS = threads
+
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    hyperparameters = {**autotuner.HYPERPARAMETERS, **configuration}
+    with open(f"{sweep_dir}/{job}.log", 'w') as log, contextlib.redirect_stdout(log):
+        learning_curve = autotuner.run_autotuner(hyperparameters, n_episodes, plant=ModelPlant(), realtime=False,
+                                                 trace_file=None, save_episodes=False)
+
+    pd.DataFrame(learning_curve, columns=['error', 'fell_back']).to_csv(f"{sweep_dir}/{job}-curve.csv", index_label='episode')
+
+    result = {'job': job, 'seed': seed, **configuration, **summarise(learning_curve)}
+    with open(f"{sweep_dir}/{job}.json.tmp", 'w') as f:
+        json.dump(result, f)
+    os.replace(f"{sweep_dir}/{job}.json.tmp", f"{sweep_dir}/{job}.json")
+    return result
+
+
+# spawned workers inherit the environment, and import this module, and with
+# it numpy, before they run anything else, so we set the limits here
+def limit_threads(threads):
+    for variable in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[variable] = str(threads)
+
+
+# only the results of the given jobs, not those left behind by other sweeps
+def load_results(sweep_dir, jobs):
+    results = []
+    for job in jobs:
+        if os.path.exists(f"{sweep_dir}/{job}.json"):
+            with open(f"{sweep_dir}/{job}.json") as f:
+                results.append(json.load(f))
+    return pd.DataFrame(results)
+
+
+def sweep(search=SEARCH, parameters=PARAMETERS, n_random=N_RANDOM, n_episodes=N_EPISODES, n_seeds=N_SEEDS,
+          base_seed=BASE_SEED, threads_per_job=THREADS_PER_JOB, n_workers=N_WORKERS, sweep_dir=SWEEP_DIR):
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    # a random search draws the same configurations each time, so it resumes too
+    np.random.seed(base_seed)
+    jobs = [(job_id(configuration, base_seed + i), configuration, base_seed + i)
+            for configuration in configurations(search, parameters, n_random)
+            for i in range(n_seeds)]
+    pending = [job for job in jobs if not os.path.exists(f"{sweep_dir}/{job[0]}.json")]
+    print(f"{len(jobs)} jobs in the sweep, {len(jobs) - len(pending)} already done, running {len(pending)}...")
+
+    # spawn fresh workers, so that the thread limits apply before numpy and torch load
+    limit_threads(threads_per_job)
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(n_workers, mp_context=context) as pool:
+        futures = {pool.submit(run_job, sweep_dir, job, configuration, seed, n_episodes, threads_per_job): job
+                   for job, configuration, seed in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+                print(f"job {job} done: {result}")
+            except Exception:
+                print(f"job {job} failed, it will run again when the sweep is resumed:\n{traceback.format_exc()}")
+
+    results = load_results(sweep_dir, [job for job, _, _ in jobs])
+    if len(results) > 0:
+        results = results.sort_values('mean_error_tail')
+        results.to_csv(f"{sweep_dir}/results.csv", index=False)
+    return results
+
+
+if __name__ == "__main__":
+    spec = {}
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            spec = json.load(f)
+
+    results = sweep(**spec)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(results)
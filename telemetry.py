@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# Live telemetry of the control loop through shared memory. The supervised plant
+# control publishes each step into a fixed-size ring buffer. Any number of local
+# processes, such as dashboards, recorders or alerts, can map that buffer and
+# read the steps as they come in, without adding I/O or latency to the control
+# loop.
+#
+# The shared memory block starts with a 64 byte header, followed by `capacity`
+# records, all little-endian:
+#
+#     offset  type     field
+#     0       char[4]  magic, b'PIDT'
+#     4       uint32   layout version, currently 2
+#     8       uint32   number of columns per record, len(EPISODE_COLUMNS)
+#     12      uint32   capacity, the number of records in the ring
+#     16      uint64   sequence, the number of records published so far
+#     24      uint32   process id of the writer
+#     28      -        reserved, up to offset 64
+#     64      float64  records[capacity][n_columns]
+#
+# Each record holds one step, with its values in the order of `EPISODE_COLUMNS`,
+# as in the episode files. Record `n` lives in slot `n % capacity`.
+#
+# There is a single writer. It writes a record into its slot first, and only
+# then bumps the sequence. A reader reads the sequence, copies the records it
+# has not seen yet, and reads the sequence again. Records that the writer may
+# have overwritten in the meantime, those `capacity` or more behind the second
+# sequence plus one, are dropped and counted as lost.
+#
+# A control process that did not exit cleanly leaves its block behind. The next
+# writer reclaims it, but only if the writer recorded in it no longer runs.
+#
+# To follow a running loop from another terminal:
+#
+#     (venv) $ python telemetry.py
+#
+
+import os
+import sys
+import time
+import atexit
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory, resource_tracker
+
+from episodes import EPISODE_COLUMNS, COL_TIME, COL_SETPOINT, COL_PROCESS_VARIABLE, COL_ERROR, COL_STATE
+
+
+TELEMETRY_NAME = "pid-telemetry"
+TELEMETRY_CAPACITY = 4096
+POLL_INTERVAL = 0.1 # seconds
+
+MAGIC = b'PIDT'
+LAYOUT_VERSION = 2
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([('magic', 'S4'), ('version', '<u4'), ('n_columns', '<u4'),
+                         ('capacity', '<u4'), ('sequence', '<u8'), ('writer', '<u4')])
+
+
+def ring_size(capacity, n_columns=len(EPISODE_COLUMNS)):
+    return HEADER_SIZE + capacity * n_columns * 8
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # running, as another user
+    return True
+
+
+# whether the block holds telemetry of a writer that is gone
+def is_stale(shm):
+    header = np.ndarray(1, dtype=HEADER_DTYPE, buffer=shm.buf)
+    magic, version, writer = header['magic'][0], header['version'][0], int(header['writer'][0])
+    del header # release the view on the buffer
+    return magic == MAGIC and version == LAYOUT_VERSION and not is_running(writer)
+
+
+#
+# The writing end, owned by the control process. The shared memory block is
+# removed when the process exits.
+#
+class TelemetryRing:
+    def __init__(self, name=TELEMETRY_NAME, capacity=TELEMETRY_CAPACITY):
+        size = ring_size(capacity)
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            existing = shared_memory.SharedMemory(name=name)
+            if not is_stale(existing):
+                # keep the resource tracker from removing it when we exit
+                resource_tracker.unregister(existing._name, 'shared_memory')
+                existing.close()
+                raise FileExistsError(f"shared memory '{name}' is in use by another process, "
+                                      f"pick another name for the telemetry")
+            print(f"reclaiming shared memory '{name}', left behind by a control process that is gone")
+            existing.close()
+            existing.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        self.capacity = capacity
+        self.header = np.ndarray(1, dtype=HEADER_DTYPE, buffer=self.shm.buf)
+        self.header[0] = (MAGIC, LAYOUT_VERSION, len(EPISODE_COLUMNS), capacity, 0, os.getpid())
+        self.records = np.ndarray((capacity, len(EPISODE_COLUMNS)), dtype='<f8', buffer=self.shm.buf, offset=HEADER_SIZE)
+
+        self.sequence = 0
+        self.published = self.header['sequence']
+        atexit.register(self.close)
+        print(f"publishing telemetry to shared memory '{name}', {capacity} steps deep")
+
+
+    def publish(self, row):
+        self.records[self.sequence % self.capacity] = row
+        self.sequence += 1
+        self.published[0] = self.sequence
+
+
+    def close(self):
+        if self.shm is None:
+            return
+        del self.header, self.records, self.published # release the views on the buffer first
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+
+#
+# The reading end. Each call to `read()` returns the records published since
+# the previous call, as an array of shape (n, len(EPISODE_COLUMNS)).
+#
+class TelemetryReader:
+    def __init__(self, name=TELEMETRY_NAME):
+        self.shm = shared_memory.SharedMemory(name=name)
+        # before Python 3.13, attaching registers the block with the resource
+        # tracker, which would then remove it when this reader exits
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self.header = np.ndarray(1, dtype=HEADER_DTYPE, buffer=self.shm.buf)
+        magic, version, n_columns, capacity, _, _ = self.header[0]
+        if magic != MAGIC or version != LAYOUT_VERSION or n_columns != len(EPISODE_COLUMNS):
+            raise ValueError(f"shared memory '{name}' holds no telemetry in layout {LAYOUT_VERSION} "
+                             f"with {len(EPISODE_COLUMNS)} columns")
+
+        self.capacity = int(capacity)
+        self.records = np.ndarray((self.capacity, n_columns), dtype='<f8', buffer=self.shm.buf, offset=HEADER_SIZE)
+        self.sequence = int(self.header['sequence'][0])
+        self.n_lost = 0
+
+
+    def read(self):
+        sequence = int(self.header['sequence'][0])
+        first = max(self.sequence, sequence - self.capacity)
+        records = self.records[np.arange(first, sequence) % self.capacity] # a copy
+
+        # drop what the writer may have overwritten while we copied, including
+        # the slot of the record it may be writing now
+        overwritten = min(len(records), max(0, int(self.header['sequence'][0]) + 1 - self.capacity - first))
+        records = records[overwritten:]
+
+        self.n_lost += first - self.sequence + overwritten
+        self.sequence = sequence
+        return records
+
+
+    def read_frame(self):
+        _df = pd.DataFrame(self.read(), columns=EPISODE_COLUMNS)
+        _df[COL_STATE] = _df[COL_STATE].astype(int)
+        return _df
+
+
+    def close(self):
+        del self.header, self.records
+        self.shm.close()
+
+
+#
+# Follow a running control loop and print its steps.
+#
+if __name__ == "__main__":
+    reader = TelemetryReader(sys.argv[1] if len(sys.argv) > 1 else TELEMETRY_NAME)
+    columns = [COL_TIME, COL_SETPOINT, COL_PROCESS_VARIABLE, COL_ERROR, COL_STATE]
+    while True:
+        steps = reader.read_frame()
+        if len(steps) > 0:
+            print(steps[columns].to_string(header=False, index=False))
+        if reader.n_lost > 0:
+            print(f"lost {reader.n_lost} steps so far")
+        time.sleep(POLL_INTERVAL)
@@ -0,0 +1,153 @@
+#
+# An index of every PID tuning that was applied to the plant, with its outcome:
+# the episode error, whether the supervisor fell back and, if so, how long it
+# took. The agents regularly propose tunings very close to ones we have already
+# tried. Looking these up before applying them saves a live episode each time:
+# tunings close to a known fall-back are rejected, and tunings close to a known,
+# stable result can reuse that result.
+#
+# Tunings are indexed on a uniform grid over normalised gains, i.e. the gains
+# divided by the scale used to map actions onto gains. With grid cells as wide
+# as the largest query radius, a neighbourhood query only needs to look at the
+# 27 cells around the query. Unlike a k-d tree, the grid needs no rebuilding as
+# tunings come in live.
+#
+# The index is kept in a Parquet file next to the episode archive, and is
+# brought up to date with episodes that are not in it yet when it is loaded.
+#
+
+import os
+import glob
+import itertools
+import numpy as np
+import pandas as pd
+
+from episodes import COL_TIME, COL_KP, COL_KI, COL_KD, COL_ERROR, COL_STATE, STATE_FALLBACK, SAVE_DIR, load_episode
+
+
+INDEX_FILE = "tuning-index.parquet"
+INDEX_COLUMNS = ['kp', 'ki', 'kd', 'error', 'fell_back', 'time_to_fallback', 'source']
+
+REJECT_RADIUS = 0.01 # in normalised gains, closer than this to a fall-back is rejected
+REUSE_RADIUS = 0.002 # in normalised gains, closer than this to a stable result reuses it
+
+VERDICT_NEW = 0
+VERDICT_REJECT = 1
+VERDICT_REUSE = 2
+
+NEIGHBOUR_CELLS = list(itertools.product((-1, 0, 1), repeat=3))
+
+
+class TuningIndex:
+    def __init__(self, scale, reject_radius=REJECT_RADIUS, reuse_radius=REUSE_RADIUS):
+        self.scale = np.asarray(scale, dtype=float)
+        self.reject_radius = reject_radius
+        self.reuse_radius = reuse_radius
+        self.cell_size = max(reject_radius, reuse_radius)
+
+        self.points = np.zeros((1024, 3)) # grows by doubling, see `add()`
+        self.records = []
+        self.cells = {}
+        self.sources = set()
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def cell(self, point):
+        return tuple(np.floor(point / self.cell_size).astype(int))
+
+
+    def add(self, pid_tunings, error, fell_back, time_to_fallback=np.nan, source=None):
+        point = np.asarray(pid_tunings, dtype=float) / self.scale
+
+        n = len(self.records)
+        if n == len(self.points):
+            self.points = np.vstack((self.points, np.zeros_like(self.points)))
+        self.points[n] = point
+
+        self.cells.setdefault(self.cell(point), []).append(n)
+        self.records.append((*pid_tunings, error, bool(fell_back), time_to_fallback, source))
+        if source is not None:
+            self.sources.add(source)
+
+
+    #
+    # Index an episode by the tunings proposed at its start.
+    #
+    def add_episode(self, episode, source=None):
+        first_step = episode.iloc[0]
+        fallback_steps = episode.index[episode[COL_STATE] == STATE_FALLBACK]
+        fell_back = len(fallback_steps) > 0
+        time_to_fallback = episode.at[fallback_steps[0], COL_TIME] if fell_back else np.nan
+
+        self.add((first_step[COL_KP], first_step[COL_KI], first_step[COL_KD]),
+                 (episode[COL_ERROR]**2).sum(), fell_back, time_to_fallback, source)
+
+
+    #
+    # The nearest indexed tuning within `max_distance` of the given tunings, as
+    # a (distance, record) tuple, or `None` when there is no such tuning.
+    #
+    def nearest(self, pid_tunings, max_distance=None):
+        if max_distance is None:
+            max_distance = self.cell_size
+
+        point = np.asarray(pid_tunings, dtype=float) / self.scale
+        reach = int(np.ceil(max_distance / self.cell_size))
+        center = np.array(self.cell(point))
+        offsets = NEIGHBOUR_CELLS if reach == 1 else itertools.product(range(-reach, reach + 1), repeat=3)
+
+        candidates = [i for offset in offsets for i in self.cells.get(tuple(center + offset), [])]
+        if len(candidates) == 0:
+            return None
+
+        distances = np.linalg.norm(self.points[candidates] - point, axis=1)
+        nearest = np.argmin(distances)
+        if distances[nearest] > max_distance:
+            return None
+        return distances[nearest], dict(zip(INDEX_COLUMNS, self.records[candidates[nearest]]))
+
+
+    #
+    # Decide what to do with a proposed tuning. Returns the verdict and the
+    # record of the nearest known tuning, if any.
+    #
+    def verdict(self, pid_tunings):
+        found = self.nearest(pid_tunings)
+        if found is None:
+            return VERDICT_NEW, None
+
+        distance, record = found
+        if record['fell_back'] and distance <= self.reject_radius:
+            return VERDICT_REJECT, record
+        if not record['fell_back'] and distance <= self.reuse_radius:
+            return VERDICT_REUSE, record
+        return VERDICT_NEW, record
+
+
+    def save(self, index_file=INDEX_FILE):
+        pd.DataFrame(self.records, columns=INDEX_COLUMNS).to_parquet(index_file)
+
+
+    #
+    # Load the index, if there is one, and add the archived episodes that are
+    # not in it yet.
+    #
+    @staticmethod
+    def load(scale, index_file=INDEX_FILE, save_dir=SAVE_DIR):
+        index = TuningIndex(scale)
+        if os.path.exists(index_file):
+            for record in pd.read_parquet(index_file).itertuples(index=False):
+                index.add((record.kp, record.ki, record.kd), record.error, record.fell_back,
+                          record.time_to_fallback, record.source)
+
+        files = sorted(set(glob.glob(f"{save_dir}/*.parquet")) - index.sources)
+        for file in files:
+            index.add_episode(load_episode(file), file)
+        if len(files) > 0:
+            print(f"indexed {len(files)} archived episodes, {len(index)} tunings in total")
+            index.save(index_file)
+
+        return index
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# A script to replay the supervisor's rule over the episode archive for many
+# benchmark errors $R_{bmk}$ at once, without running live episodes. For each
+# candidate $R_{bmk}$ it reports how often and how soon the supervisor would
+# have fallen back, how often it would have cut short a good episode, and how
+# much error that would have saved compared to what actually happened.
+#
+#     (venv) $ python what_if_supervisor.py episodes/*.parquet
+#
+# The archive only tells us how the proposed tunings did until the supervisor
+# fell back. After that, the errors are those of the fall-back tunings. So a
+# candidate $R_{bmk}$ that would have fallen back later than the archive did
+# has an undetermined outcome; these episodes are counted, but left out of the
+# rates and the error saved. After a fall-back, the error is estimated as the
+# fall-back tunings' average error per second in the archive.
+#
+# An episode counts as good when it ran to the end under its proposed tunings,
+# with an error no larger than the reference error. That is the error of the
+# fall-back tunings over an episode, by default the median $R_{bmk}$ of the
+# archive. A fall-back in a good episode is a false trigger.
+#
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from episodes import COL_ERROR, COL_STATE, COL_BENCHMARK, STATE_FALLBACK, EpisodeConfig, load_episode
+
+
+N_THRESHOLDS = 400
+THRESHOLD_RANGE = (0.25, 4.0) # relative to the reference error
+REFERENCE_ERROR = None        # the median R_bmk of the archive, if None
+FALLBACK_ERROR_RATE = None    # squared error per second under fall-back tunings, measured if None
+
+WHAT_IF_FILE = "what-if.csv"
+
+
+#
+# The archive as a stack of episodes × steps arrays, padded with zeros to the
+# longest episode. Episodes keep their own configuration, so their own length
+# and sample rate.
+#
+class EpisodeStack:
+    def __init__(self, episodes):
+        self.n_episodes = len(episodes)
+        self.lengths = np.array([len(episode) for episode in episodes])
+        self.sample_rates = np.array([EpisodeConfig.of(episode).sample_rate for episode in episodes], dtype=float)
+        self.benchmark_errors = np.array([episode[COL_BENCHMARK].iloc[0] for episode in episodes])
+
+        self.squared_errors = np.zeros((self.n_episodes, self.lengths.max(initial=0)))
+        self.is_fallback = np.zeros(self.squared_errors.shape, dtype=bool)
+        for i, episode in enumerate(episodes):
+            self.squared_errors[i, :len(episode)] = episode[COL_ERROR].to_numpy()**2
+            self.is_fallback[i, :len(episode)] = episode[COL_STATE].to_numpy() == STATE_FALLBACK
+
+        # the steps that ran under the proposed tunings come before the first fall-back step
+        self.fell_back = self.is_fallback.any(axis=1)
+        self.proposed_steps = np.where(self.fell_back, self.is_fallback.argmax(axis=1), self.lengths)
+
+        proposed = np.arange(self.squared_errors.shape[1]) < self.proposed_steps[:, None]
+        self.running_errors = np.cumsum(np.where(proposed, self.squared_errors, 0.0), axis=1)
+
+
+    def fallback_error_rate(self, reference_error):
+        fallback_seconds = (self.is_fallback.sum(axis=1) / self.sample_rates).sum()
+        if fallback_seconds == 0:
+            episode_seconds = (self.lengths / self.sample_rates).mean()
+            return reference_error / episode_seconds
+        return self.squared_errors[self.is_fallback].sum() / fallback_seconds
+
+
+    #
+    # The first step at which the running error exceeds each of the thresholds,
+    # for each episode, as an episodes × thresholds array. Running errors only
+    # grow, so offsetting each episode by more than the largest value makes the
+    # whole stack one sorted array, and a single `np.searchsorted()` does it.
+    #
+    def first_steps_over(self, thresholds):
+        n_steps = self.running_errors.shape[1]
+        offset = max(self.running_errors.max(initial=0.0), thresholds.max()) + 1.0
+        offsets = np.arange(self.n_episodes)[:, None] * offset
+
+        steps = np.searchsorted((self.running_errors + offsets).ravel(), thresholds[None, :] + offsets, side='right')
+        return steps - np.arange(self.n_episodes)[:, None] * n_steps
+
+
+def what_if(stack, thresholds, reference_error, fallback_error_rate):
+    episodes = np.arange(stack.n_episodes)[:, None]
+    last_steps = stack.lengths[:, None] - 1
+    error_per_step = (fallback_error_rate / stack.sample_rates)[:, None]
+
+    steps = stack.first_steps_over(thresholds)
+    triggered = steps < stack.proposed_steps[:, None]
+    undetermined = ~triggered & stack.fell_back[:, None]
+    determined = ~undetermined
+
+    # the estimated episode error when falling back after the given step
+    def error_with_fallback(step):
+        return stack.running_errors[episodes, step] + error_per_step * (last_steps - step)
+
+    final_errors = stack.running_errors[episodes, last_steps]
+    archived_errors = np.where(stack.fell_back[:, None],
+                               error_with_fallback(np.maximum(stack.proposed_steps[:, None] - 1, 0)),
+                               final_errors)
+    what_if_errors = np.where(triggered, error_with_fallback(np.minimum(steps, last_steps)), final_errors)
+    error_saved = np.where(determined, archived_errors - what_if_errors, 0.0)
+    time_to_fallback = np.where(triggered, steps / stack.sample_rates[:, None], 0.0)
+
+    good = ~stack.fell_back & (final_errors[:, 0] <= reference_error)
+    n_determined = np.maximum(determined.sum(axis=0), 1)
+    n_triggered = triggered.sum(axis=0)
+
+    return pd.DataFrame({
+        'r_bmk': thresholds,
+        'fallback_rate': n_triggered / n_determined,
+        'undetermined_rate': undetermined.mean(axis=0),
+        'mean_time_to_fallback': np.where(n_triggered > 0, time_to_fallback.sum(axis=0) / np.maximum(n_triggered, 1), np.nan),
+        'false_trigger_rate': (triggered & good[:, None]).sum(axis=0) / max(good.sum(), 1),
+        'mean_error_saved': error_saved.sum(axis=0) / n_determined,
+    })
+
+
+if __name__ == "__main__":
+    files = sorted(sys.argv[1:])
+    stack = EpisodeStack([load_episode(file) for file in files])
+
+    reference_error = REFERENCE_ERROR if REFERENCE_ERROR is not None else float(np.median(stack.benchmark_errors))
+    fallback_error_rate = FALLBACK_ERROR_RATE if FALLBACK_ERROR_RATE is not None else stack.fallback_error_rate(reference_error)
+    thresholds = np.linspace(*THRESHOLD_RANGE, N_THRESHOLDS) * reference_error
+
+    start_time = time.perf_counter()
+    results = what_if(stack, thresholds, reference_error, fallback_error_rate)
+    duration = time.perf_counter() - start_time
+
+    print(f"replayed {len(thresholds)} thresholds over {stack.n_episodes} episodes in {duration * 1000:.0f} ms")
+    print(f"reference error {reference_error:.2f}, fall-back error rate {fallback_error_rate:.3f} per second")
+    results.to_csv(WHAT_IF_FILE, index=False)
+
+    best = results.loc[results['mean_error_saved'].idxmax()]
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(results.iloc[np.linspace(0, len(results) - 1, 20).astype(int)].to_string(index=False))
+        print(f"most error saved at R_bmk {best['r_bmk']:.2f}:\n{best.to_string()}")